@@ -0,0 +1,239 @@
+"""
+asyncio counterparts of botleague_helpers.db for callers driving many
+concurrent operations from one event loop. Blocking callers should keep
+using get_db().
+"""
+import asyncio
+import functools
+from typing import Any, AsyncGenerator, Callable, List, Tuple
+
+from box import Box
+
+from botleague_helpers.config import blconfig
+from botleague_helpers.config import get_test_name_from_callstack
+from botleague_helpers.db import DEFAULT_COLLECTION, UNCHANGED, DB, \
+    DBFirestore, DBLocal, DBSqlite, FirestorePager, cas_matches, \
+    deserialize, serialize
+
+
+class AsyncDB:
+    db = None
+    collection = None
+
+    def __init__(self, collection_name, use_boxes):
+        self.collection_name = collection_name or DEFAULT_COLLECTION
+        self.use_boxes = use_boxes
+
+    async def get(self, key) -> Any:
+        ret = await self._get(key)
+        return deserialize(ret, self.use_boxes)
+
+    async def set(self, key, value) -> Any:
+        return await self._set(key, serialize(value, self.use_boxes))
+
+    async def delete(self, key):
+        return await self._delete(key)
+
+    async def compare_and_swap(self, key, expected_current_value,
+                               new_value) -> bool:
+        """See DB.compare_and_swap"""
+        expected_current_value = serialize(expected_current_value,
+                                           self.use_boxes)
+        return await self.update_if(
+            key, lambda current: cas_matches(
+                serialize(current, self.use_boxes), expected_current_value),
+            new_value)
+
+    cas = compare_and_swap
+
+    async def transact(self, key, fn: Callable[[Any], Any]) -> Any:
+        """See DB.transact. fn is a regular, non-async function."""
+        last_read = Box(value=None)
+
+        def raw_fn(raw_value):
+            current = deserialize(raw_value, self.use_boxes)
+            last_read.value = current
+            new_value = fn(current)
+            if new_value is UNCHANGED:
+                return UNCHANGED
+            return serialize(new_value, self.use_boxes)
+
+        await self._transact(key, raw_fn)
+        return last_read.value
+
+    async def update_if(self, key, predicate: Callable[[Any], bool],
+                        new_value) -> bool:
+        updated = Box(value=False)
+
+        def fn(current):
+            updated.value = bool(predicate(current))
+            return new_value if updated.value else UNCHANGED
+
+        await self.transact(key, fn)
+        return updated.value
+
+    async def where(self, field: str, op: str, value,
+                    limit: int = None,
+                    order_by: str = None,
+                    descending: bool = False,
+                    start_after: dict = None,
+                    select: List[str] = None,
+                    page_size: int = None) -> AsyncGenerator:
+        """See DB.where"""
+        options = Box(limit=limit, order_by=order_by, descending=descending,
+                      start_after=start_after, select=select,
+                      page_size=page_size)
+        async for item in self._where(field, op, value, options):
+            yield deserialize(item, self.use_boxes)
+
+    async def wait_for_change(self, key, timeout: float) -> bool:
+        """
+        Wait up to timeout seconds for key to change, or just sleep if the
+        backend can't notify us.
+        :return: True if the key changed
+        """
+        await asyncio.sleep(timeout)
+        return False
+
+    async def _get(self, key) -> Any:
+        raise NotImplementedError()
+
+    async def _set(self, key, value) -> Any:
+        raise NotImplementedError()
+
+    async def _delete(self, key) -> Any:
+        raise NotImplementedError()
+
+    async def _transact(self, key, fn) -> Tuple[Any, Any]:
+        raise NotImplementedError()
+
+    def _where(self, field, op, value, options: Box) -> AsyncGenerator:
+        raise NotImplementedError()
+
+
+class AsyncDBFirestore(AsyncDB):
+    def __init__(self, collection_name, use_boxes):
+        super().__init__(collection_name, use_boxes)
+        from firebase_admin import firestore_async
+        blconfig.ensure_firebase_initialized()
+        self.db = firestore_async.client()
+        self.collection = self.db.collection(self.collection_name)
+
+    async def _get(self, key):
+        snapshot = await self.collection.document(key).get()
+        return DBFirestore._simplify_value(key, snapshot.to_dict() or {})
+
+    async def _set(self, key, value):
+        value = DBFirestore._expand_value(key, value)
+        return await self.collection.document(key).set(value)
+
+    async def _delete(self, key):
+        return await self.collection.document(key).delete()
+
+    async def _transact(self, key, fn):
+        from google.cloud import firestore
+        ref = self.collection.document(key)
+        transaction = self.db.transaction()
+
+        @firestore.async_transactional
+        async def run_in_transaction(transaction_):
+            snapshot = await ref.get(transaction=transaction_)
+            current = DBFirestore._simplify_value(
+                key, snapshot.to_dict() or {})
+            new_value = fn(current)
+            if new_value is not UNCHANGED:
+                transaction_.set(ref, DBFirestore._expand_value(key, new_value))
+            return current, new_value
+
+        return await run_in_transaction(transaction)
+
+    async def _where(self, field, op, value, options):
+        pager = FirestorePager(self.collection, field, op, value, options)
+        page_query = pager.next_page()
+        while page_query is not None:
+            async for snapshot in page_query.stream():
+                yield pager.add(snapshot)
+            page_query = pager.next_page()
+
+
+class AsyncDBWrapper(AsyncDB):
+    """
+    Async interface to a synchronous local DB. Calls run on the event loop
+    when they can't block for long (DBLocal), else in the default executor.
+    """
+    def __init__(self, sync_db: DB, run_inline: bool):
+        super().__init__(sync_db.collection_name, sync_db.use_boxes)
+        self.sync_db = sync_db
+        self.run_inline = run_inline
+
+    async def _run(self, fn, *args):
+        if self.run_inline:
+            return fn(*args)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, functools.partial(fn, *args))
+
+    async def _get(self, key):
+        return await self._run(self.sync_db._get, key)
+
+    async def _set(self, key, value):
+        return await self._run(self.sync_db._set, key, value)
+
+    async def _delete(self, key):
+        return await self._run(self.sync_db._delete, key)
+
+    async def _transact(self, key, fn):
+        return await self._run(self.sync_db._transact, key, fn)
+
+    async def _where(self, field, op, value, options):
+        docs = await self._run(
+            lambda: list(self.sync_db._where(field, op, value, options)))
+        for doc in docs:
+            yield doc
+
+    def delete_all_test_data(self):
+        return self.sync_db.delete_all_test_data()
+
+
+class AsyncDBLocal(AsyncDBWrapper):
+    def __init__(self, collection_name, use_boxes):
+        super().__init__(DBLocal(collection_name, use_boxes), run_inline=True)
+
+    async def wait_for_change(self, key, timeout: float) -> bool:
+        loop = asyncio.get_event_loop()
+        changed = asyncio.Event()
+
+        def listener():
+            # Writes can come from other threads
+            loop.call_soon_threadsafe(changed.set)
+
+        notifier = self.sync_db.notifier
+        notifier.subscribe(key, listener)
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            notifier.unsubscribe(key, listener)
+
+
+def get_async_db(collection_name: str = DEFAULT_COLLECTION,
+                 force_firestore_db=False,
+                 use_boxes=True) -> AsyncDB:
+    """
+    Async version of get_db, see get_db for params
+    """
+    test_name = get_test_name_from_callstack()
+    if test_name and not force_firestore_db:
+        print('We are in a test, %s, so not using Firestore' % test_name)
+        return AsyncDBLocal(collection_name, use_boxes)
+    elif blconfig.should_use_firestore:
+        return AsyncDBFirestore(collection_name, use_boxes)
+    elif blconfig.sqlite_db_path:
+        print('SHOULD_USE_FIRESTORE is false, so using SQLite db at %s' %
+              blconfig.sqlite_db_path)
+        return AsyncDBWrapper(DBSqlite(collection_name, use_boxes),
+                              run_inline=False)
+    else:
+        print('SHOULD_USE_FIRESTORE is false, so not using Firestore')
+        return AsyncDBLocal(collection_name, use_boxes)
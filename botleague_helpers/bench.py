@@ -0,0 +1,242 @@
+import inspect
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import List, Tuple
+
+from loguru import logger as log
+
+from botleague_helpers import indexes
+from botleague_helpers.db import DBLocal, DBSqlite
+
+BENCH_DB_NAME = 'test_bench_delete_me'
+
+
+def bench_local_cas(num_threads=8, increments_per_thread=5000):
+    """
+    Hammer DBLocal CAS from num_threads threads, each incrementing a
+    shared counter plus one counter of its own.
+    """
+    db = DBLocal(BENCH_DB_NAME, use_boxes=False)
+    db.set('shared', 0)
+    attempts = [0] * num_threads
+
+    def increment(key, thread_index):
+        while True:
+            attempts[thread_index] += 1
+            current = db.get(key)
+            if db.compare_and_swap(key, current, (current or 0) + 1):
+                return
+
+    def work(thread_index):
+        own_key = f'own_{thread_index}'
+        for _ in range(increments_per_thread):
+            increment('shared', thread_index)
+            increment(own_key, thread_index)
+
+    threads = [threading.Thread(target=work, args=(i,))
+               for i in range(num_threads)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    assert db.get('shared') == num_threads * increments_per_thread
+    total_attempts = sum(attempts)
+    log.info(f'DBLocal CAS: {num_threads} threads, '
+             f'{total_attempts} CAS attempts in {elapsed:.3f}s, '
+             f'{total_attempts / elapsed:,.0f} ops/sec, '
+             f'{total_attempts - 2 * num_threads * increments_per_thread} '
+             f'retries')
+    db.delete_all_test_data()
+
+
+def bench_sqlite_cas(num_processes=4, increments_per_process=250):
+    """
+    Increment one counter with CAS from several processes sharing a
+    DBSqlite file.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = f'{tmp_dir}/bench.db'
+        DBSqlite(BENCH_DB_NAME, use_boxes=False, path=path).set('shared', 0)
+        start = time.time()
+        with multiprocessing.Pool(num_processes) as pool:
+            attempts = pool.starmap(
+                _sqlite_increment,
+                [(path, increments_per_process)] * num_processes)
+        elapsed = time.time() - start
+        db = DBSqlite(BENCH_DB_NAME, use_boxes=False, path=path)
+        assert db.get('shared') == num_processes * increments_per_process
+    total_attempts = sum(attempts)
+    log.info(f'DBSqlite CAS: {num_processes} processes, '
+             f'{total_attempts} CAS attempts in {elapsed:.3f}s, '
+             f'{total_attempts / elapsed:,.0f} ops/sec')
+
+
+def _sqlite_increment(path, num_increments) -> int:
+    db = DBSqlite(BENCH_DB_NAME, use_boxes=False, path=path)
+    attempts = 0
+    for _ in range(num_increments):
+        while True:
+            attempts += 1
+            current = db.get('shared')
+            if db.compare_and_swap('shared', current, current + 1):
+                break
+    return attempts
+
+
+def bench_local_where(sizes=(10000, 100000), num_queries=20):
+    """Compare DBLocal.where latency with and without indexes"""
+    for size in sizes:
+        db = DBLocal(BENCH_DB_NAME, use_boxes=False)
+        db.set_many({f'bot_{i}': dict(score=i, problem=f'problem_{i % 100}')
+                     for i in range(size)})
+        queries = [('problem', '==', 'problem_7'),
+                   ('score', '>=', size - 100)]
+        for indexed in [False, True]:
+            if indexed:
+                db.add_index('problem', indexes.HASH)
+                db.add_index('score', indexes.SORTED)
+            for query in queries:
+                start = time.time()
+                for _ in range(num_queries):
+                    num_results = len(list(db.where(*query)))
+                per_query = (time.time() - start) / num_queries
+                log.info(f'DBLocal where {query} on {size} docs, '
+                         f'{"indexed" if indexed else "scan"}: '
+                         f'{per_query * 1000:.3f}ms, {num_results} results')
+        db.delete_all_test_data()
+
+
+def bench_kms_dict(num_fields=20, setup_seconds=0.05, request_seconds=0.02):
+    """
+    Encrypt and decrypt a dict secret against a fake KMS, creating a client
+    per call and going one field at a time like we used to, vs pooled
+    clients and concurrent requests.
+    """
+    from botleague_helpers import crypto
+    crypto.use_fake_kms(setup_seconds, request_seconds)
+    secret = {f'field_{i}': f'value_{i}' for i in range(num_fields)}
+
+    start = time.time()
+    encrypted = {}
+    for k, v in secret.items():
+        crypto.reset_kms_clients()
+        encrypted[k] = crypto.encrypt_symmetric(v)
+    for k, v in encrypted.items():
+        crypto.reset_kms_clients()
+        assert crypto.decrypt_symmetric(v) == secret[k]
+    unpooled = time.time() - start
+
+    start = time.time()
+    encrypted = crypto.map_fields(crypto.encrypt_symmetric, secret)
+    assert crypto.map_fields(crypto.decrypt_symmetric, encrypted) == secret
+    pooled = time.time() - start
+    log.info(f'KMS {num_fields} field round trip: client per call, '
+             f'sequential {unpooled:.3f}s, pooled concurrent {pooled:.3f}s')
+    crypto.reset_kms_clients()
+    crypto.kms_client_factory = crypto._create_kms_client
+
+
+def bench_test_name_from_callstack(num_calls=2000, depth=30):
+    """
+    Per call cost of finding the test name, as on every log record, with
+    inspect.stack() like we used to vs walking frames.
+    """
+    from botleague_helpers import config
+
+    def inspect_stack_version():
+        for level in inspect.stack():
+            if level.function.startswith('test_'):
+                return level.function[len('test_'):]
+        return ''
+
+    def at_depth(fn, remaining):
+        if remaining:
+            return at_depth(fn, remaining - 1)
+        start = time.time()
+        for _ in range(num_calls):
+            fn()
+        return (time.time() - start) / num_calls
+
+    for name, fn in [('inspect.stack', inspect_stack_version),
+                     ('frame walk', config.get_test_name_from_callstack)]:
+        per_call = at_depth(fn, depth)
+        log.info(f'Test name from {depth} deep call stack, {name}: '
+                 f'{per_call * 1e6:,.1f}us per call')
+
+
+HEAVY_SDK_PREFIXES = ('google.cloud', 'firebase_admin', 'github', 'slack',
+                      'grpc')
+
+
+def bench_import_time(statements=(
+        'from botleague_helpers.db import get_db',
+        'import botleague_helpers.logs',
+        'import botleague_helpers.reduce')):
+    """
+    Import time with SHOULD_USE_FIRESTORE=false, none of which should load
+    a Google, GitHub or Slack SDK
+    """
+    for statement in statements:
+        total_us, modules = get_import_times(statement)
+        heavy = sorted(m for m in modules if m.startswith(HEAVY_SDK_PREFIXES))
+        log.info(f'{statement}: {total_us / 1000:.1f}ms, '
+                 f'{len(modules)} modules')
+        assert not heavy, f'{statement} imported {heavy}'
+
+
+def get_import_times(statement: str) -> Tuple[int, List[str]]:
+    """
+    Run statement in a fresh interpreter with python -X importtime
+    :return: (total cumulative import microseconds, modules imported)
+    """
+    env = dict(os.environ, SHOULD_USE_FIRESTORE='false')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        env=env, stderr=subprocess.PIPE, universal_newlines=True,
+        check=True)
+    total_us = 0
+    modules = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.append(name.strip())
+        if not name.startswith('  '):
+            # Top level imports include their children's time
+            total_us += int(cumulative)
+    return total_us, modules
+
+
+def run_all(current_module):
+    log.info('Running all benchmarks')
+    num = 0
+    for attr in dir(current_module):
+        if attr.startswith('bench_'):
+            num += 1
+            log.info('Running ' + attr)
+            getattr(current_module, attr)()
+    return num
+
+
+def main():
+    bench_module = sys.modules[__name__]
+    if len(sys.argv) > 1:
+        getattr(bench_module, sys.argv[1])()
+    else:
+        num = run_all(bench_module)
+        log.success(f'{num} benchmarks ran')
+
+
+# Usage
+#   python -m botleague_helpers.bench [bench_name]
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from typing import Any, Tuple
+
+from box import Box
+
+
+class CachePolicy:
+    def __init__(self, ttl: float = None, max_entries: int = 1024):
+        """
+        :param ttl: Seconds an entry stays fresh. None means entries only
+            leave the cache through eviction or invalidation.
+        :param max_entries: Least recently used entries are evicted past this
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+
+class LRUCache:
+    """
+    Thread-safe, bounded, least-recently-used cache with optional TTL.
+
+    Values are deep copied on the way in and out so callers can't mutate
+    the cached copy through a returned Box / dict.
+    """
+    def __init__(self, policy: CachePolicy = None):
+        self.policy = policy or CachePolicy()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key => (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Tuple[bool, Any]:
+        """:return: (found, value)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or time.time() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, deepcopy(value)
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        ttl = self.policy.ttl
+        expires_at = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._entries[key] = (expires_at, deepcopy(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.policy.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self) -> Box:
+        return Box(hits=self.hits, misses=self.misses,
+                   evictions=self.evictions, size=len(self))
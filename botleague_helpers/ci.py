@@ -1,30 +1,57 @@
-import json
 import os
 import sys
-from typing import List, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, List, Optional, Tuple, Union
 
 import time
 
 import requests
 from box import Box, BoxList
 from github import Github
-from retry import retry
-from github import UnknownObjectException
 from loguru import logger as log
 
-from botleague_helpers.utils import box2json
+from botleague_helpers.utils import box2json, get_file_and_sha_from_github
 from botleague_helpers.config import blconfig
+from botleague_helpers.github_limits import GITHUB_API_URL, \
+    github_request, install_pygithub_hooks
+from botleague_helpers.sessions import configure_endpoint, get_session, \
+    idempotent_retry, parse_retry_after
+from botleague_helpers.waiter import MAX_POLL_SECONDS, MIN_POLL_SECONDS, \
+    CallbackListener, Pending, wait_for
 
 DEFAULT_BOTLEAGUE_LIAISON_HOST = 'https://liaison.botleague.io'
 BOTLEAGUE_LIAISON_HOST = os.environ.get('BOTLEAGUE_LIAISON_HOST') or \
                          DEFAULT_BOTLEAGUE_LIAISON_HOST
 
+DEEPDRIVE_SIM_HOST = 'https://sim.deepdrive.io'
+
+# Status checks are safe to repeat, unlike starting builds or creating PRs
+configure_endpoint(f'{BOTLEAGUE_LIAISON_HOST}/problem_ci_status',
+                   idempotent_retry(['POST']))
+configure_endpoint(f'{DEEPDRIVE_SIM_HOST}/job/status',
+                   idempotent_retry(['POST']))
+
+# Overall seconds to wait for a build job and for problem CI's
+JOB_TIMEOUT = 60 * 60 * 2
+PROBLEM_CI_TIMEOUT = 60 * 60 * 4
+
+# Concurrent GitHub requests when creating problem CI PRs
+MAX_PR_WORKERS = 8
+
+# Polling problem CI's
+MAX_CI_POLL_WORKERS = 16
+MAX_POLL_ERRORS = 5
+
+# The liaison may not know about a PR we just created
+NOT_FOUND_TIMEOUT = 60 * 5
+
 def build_and_run_botleague_ci(build_url, run_botleague_ci_wrapper_fn):
     build_id = os.environ.get('CIRCLE_BUILD_NUM') or \
                generate_rand_alphanumeric(6)
     commit = os.environ['CIRCLE_SHA1']
     branch = os.environ['CIRCLE_BRANCH']
-    resp = requests.post(build_url, json=dict(
+    resp = get_session().post(build_url, json=dict(
         build_id=build_id,
         commit=commit,
         branch=branch,
@@ -45,6 +72,7 @@ def run_botleague_ci(branch, version, set_version_fn, pr_message,
     # Send pull request to Botleague
     log.info('Sending pull requests to botleague for supported problems')
     github_token = os.environ['BOTLEAGUE_GITHUB_TOKEN']
+    install_pygithub_hooks()
     github_client = Github(github_token)
     # Get our fork owner
     botleague_fork_owner = 'deepdrive'
@@ -52,9 +80,9 @@ def run_botleague_ci(branch, version, set_version_fn, pr_message,
     # NOTE: Fork on github was manually created
     botleague_fork = github_client.get_repo(
         f'{botleague_fork_owner}/botleague')
-    problem_cis = BoxList()
-    for problem in supported_problems:
-        hash_to_branch_from = get_head_commit('botleague/botleague', github_token)
+    hash_to_branch_from = get_head_commit('botleague/botleague', github_token)
+
+    def create_problem_ci(problem) -> Box:
         botleague_branch_name = f'deepdrive_{version}_' \
             f'id-{generate_rand_alphanumeric(3)}'
         fork_ref = botleague_fork.create_git_ref(
@@ -94,8 +122,9 @@ def run_botleague_ci(branch, version, set_version_fn, pr_message,
             token=github_token)
 
         head_sha = Box(update_resp).commit.sha
-        problem_cis.append(Box(pr_number=pull_resp.json()['number'],
-                               commit=head_sha))
+        return Box(pr_number=pull_resp.json()['number'], commit=head_sha)
+
+    problem_cis = create_problem_cis(supported_problems, create_problem_ci)
     problem_cis = wait_for_problem_cis(problem_cis)
     if all(p.status == 'passed' for p in problem_cis):
         log.success(f'Problem ci\'s passed! Problem cis were: '
@@ -108,6 +137,36 @@ def run_botleague_ci(branch, version, set_version_fn, pr_message,
                  f'{box2json(problem_cis)}. Check PRs for errors {ci_urls}')
 
 
+def create_problem_cis(problems: List[str],
+                       create_fn: Callable[[str], Box],
+                       max_workers=MAX_PR_WORKERS) -> BoxList:
+    """
+    Call create_fn for each problem concurrently
+    :return: create_fn's results in the order of problems
+    :raises RuntimeError: Listing each problem that failed and why
+    """
+    with ThreadPoolExecutor(max(1, min(max_workers, len(problems)))) as \
+            executor:
+        futures = [executor.submit(create_fn, p) for p in problems]
+    problem_cis = BoxList()
+    errors = []
+    for problem, future in zip(problems, futures):
+        error = future.exception()
+        if error is None:
+            problem_cis.append(future.result())
+        else:
+            log.opt(exception=error).error(
+                f'Could not create problem ci for {problem}')
+            errors.append(f'{problem}: {error!r}')
+    if errors:
+        created = ', '.join(str(p.pr_number) for p in problem_cis) or 'none'
+        raise RuntimeError(f'Could not create problem ci\'s for '
+                           f'{len(errors)} of {len(problems)} problems. '
+                           f'Created PRs: {created}. '
+                           f'Errors:\n' + '\n'.join(errors))
+    return problem_cis
+
+
 def set_pull_body(pull, sim_url=None, container_postfix=None):
     pull.body = Box()
     if sim_url:
@@ -117,37 +176,112 @@ def set_pull_body(pull, sim_url=None, container_postfix=None):
     pull.body = pull.body.to_json()
 
 
-def wait_for_problem_cis(problem_cis: BoxList) -> BoxList:
+def wait_for_problem_cis(problem_cis: BoxList,
+                         max_workers=MAX_CI_POLL_WORKERS,
+                         timeout=PROBLEM_CI_TIMEOUT,
+                         min_poll_seconds=MIN_POLL_SECONDS,
+                         max_poll_seconds=MAX_POLL_SECONDS,
+                         metrics: Box = None) -> BoxList:
+    """
+    Poll all outstanding problem CI's concurrently until none are pending,
+    backing off while nothing changes and honoring Retry-After.
+    :return: problem_cis with their final status set
+    """
     log.info(f'Waiting for problem cis {problem_cis.to_json()} to complete...')
-    def problem_cis_complete():
-        for pci in problem_cis:
-            status_resp = get_problem_ci_status(pci.pr_number, pci.commit)
-            status_resp = dbox(status_resp.json())
-            pci.status = status_resp.status
-            if status_resp.status in ['pending', 'not-found']:
-                return None
-            elif status_resp.status == 'not-found':
+    start = time.time()
+    outstanding = list(problem_cis)
+    metrics = Box() if metrics is None else metrics
+
+    def poll(executor):
+        nonlocal outstanding
+        retry_afters = list(executor.map(poll_problem_ci, outstanding))
+        for pci in outstanding:
+            if pci.get('status') == 'not-found' and \
+                    time.time() - start > NOT_FOUND_TIMEOUT:
                 raise RuntimeError(f'Problem CI not found. Looking for: '
                                    f'{box2json(pci)}')
-        return problem_cis
-    return wait_for_fn(problem_cis_complete)
-
-
-def wait_for_fn(fn: callable):
-    last_log_time = None
-    while True:
-        ret = fn()
-        if ret is not None:
-            return ret
-        elif not last_log_time or time.time() - last_log_time > 5:
-            print('.', end='', flush=True)
-            last_log_time = time.time()
-        time.sleep(1)
+        still_outstanding = [pci for pci in outstanding
+                             if not problem_ci_complete(pci)]
+        # Others may finish soon too if some just did
+        progressed = len(still_outstanding) < len(outstanding)
+        outstanding = still_outstanding
+        if not outstanding:
+            return problem_cis
+        return Pending(progressed=progressed,
+                       retry_after=max(r or 0 for r in retry_afters))
+
+    with ThreadPoolExecutor(
+            max(1, min(max_workers, len(outstanding)))) as executor:
+        wait_for(partial(poll, executor), name='problem cis',
+                 timeout=timeout, min_poll_seconds=min_poll_seconds,
+                 max_poll_seconds=max_poll_seconds, metrics=metrics)
+    log.info(f'Problem cis finished in {metrics.wait_seconds:.1f}s, '
+             f'{metrics.polls} polls')
+    for pci in problem_cis:
+        pci.pop('poll_errors', None)
+    return problem_cis
+
+
+def problem_ci_complete(pci: Box) -> bool:
+    return pci.get('status') not in [None, 'pending', 'not-found'] and \
+        not pci.get('poll_errors')
+
+
+def poll_problem_ci(pci: Box) -> Optional[float]:
+    """
+    Set pci.status from the liaison, tolerating up to MAX_POLL_ERRORS
+    consecutive errors
+    :return: Seconds the server asked us to wait before polling again
+    """
+    try:
+        status_resp = get_session().post(
+            f'{BOTLEAGUE_LIAISON_HOST}/problem_ci_status',
+            json=dict(commit=pci.commit, pr_number=pci.pr_number))
+    except requests.RequestException as e:
+        status_resp = None
+        error = e
+    else:
+        error = f'HTTP {status_resp.status_code}'
+    retry_after = get_retry_after(status_resp)
+    if status_resp is not None and status_resp.ok:
+        pci.status = dbox(status_resp.json()).status
+        pci.poll_errors = 0
+    elif retry_after is None:
+        # Throttling isn't an error, but anything else counts
+        pci.poll_errors = pci.get('poll_errors', 0) + 1
+        log.warning(f'Error getting problem ci status for PR '
+                    f'{pci.pr_number}: {error}')
+        if pci.poll_errors >= MAX_POLL_ERRORS:
+            raise RuntimeError(f'Error getting problem ci status for '
+                               f'{box2json(pci)}: {error}')
+    return retry_after
+
+
+def get_retry_after(resp: Optional[requests.Response]) -> Optional[float]:
+    """:return: Seconds from a Retry-After header, if any"""
+    if resp is None:
+        return None
+    return parse_retry_after(resp.headers.get('Retry-After'))
+
+
+def wait_for_fn(fn: callable, timeout: float = None, **wait_for_kwargs):
+    """
+    Call fn until it returns something other than None
+    :param wait_for_kwargs: See waiter.wait_for
+    """
+    return wait_for(fn, name=getattr(fn, '__name__', ''), timeout=timeout,
+                    **wait_for_kwargs)
 
 
-def wait_for_build_result(job_id) -> Tuple[bool, Box]:
+def wait_for_build_result(job_id, timeout=JOB_TIMEOUT,
+                          callback: CallbackListener = None) -> \
+        Tuple[bool, Box]:
     log.info(f'Waiting for build job: {job_id} to complete...')
-    job = wait_for_job_to_finish(job_id)
+    metrics = Box()
+    job = wait_for_job_to_finish(job_id, timeout=timeout, callback=callback,
+                                 metrics=metrics)
+    log.info(f'Waited {metrics.wait_seconds:.1f}s for build job, '
+             f'{metrics.polls} polls')
     if job.results.errors:
         log.error(f'Build finished with errors. Job details:\n'
                   f'{box2json(job)}')
@@ -162,35 +296,46 @@ def wait_for_build_result(job_id) -> Tuple[bool, Box]:
 
     return ret, job
 
-def wait_for_job_to_finish(job_id) -> Box:
-    last_log_time = None
-    while True:
+
+def wait_for_job_to_finish(job_id, timeout=JOB_TIMEOUT,
+                           callback: CallbackListener = None,
+                           min_poll_seconds=MIN_POLL_SECONDS,
+                           metrics: Box = None) -> Box:
+    """
+    :param callback: Poll as soon as something is POSTed to this listener,
+        i.e. by a job server we've given callback.url to
+    :param metrics: [Optional] Box to fill, see waiter.wait_for
+    """
+    def poll():
         status_resp = get_job_status(job_id)
+        if status_resp is None:
+            # Already logged by get_job_status
+            return Pending()
         job_status = dbox(status_resp.json())
         if job_status.status == 'finished':
-            print()  # End ... line
             return job_status
-        elif not last_log_time or time.time() - last_log_time > 5:
-            print('.', end='', flush=True)
-            last_log_time = time.time()
-        time.sleep(1)
+        return Pending(retry_after=get_retry_after(status_resp))
+
+    return wait_for(poll, name=f'job {job_id}', timeout=timeout,
+                    min_poll_seconds=min_poll_seconds,
+                    wait_fn=callback.wait if callback else None,
+                    metrics=metrics)
 
 
 @log.catch
-@retry(tries=5, jitter=(0, 1), logger=log)
 def get_problem_ci_status(pr_number: int, commit: str):
-    status_resp = requests.post(f'{BOTLEAGUE_LIAISON_HOST}/problem_ci_status',
-                                json=dict(commit=commit, pr_number=pr_number))
+    status_resp = get_session().post(
+        f'{BOTLEAGUE_LIAISON_HOST}/problem_ci_status',
+        json=dict(commit=commit, pr_number=pr_number))
     if not status_resp.ok:
         raise RuntimeError('Error getting job status')
     return status_resp
 
 
 @log.catch
-@retry(tries=5, jitter=(0, 1), logger=log)
 def get_job_status(job_id):
-    status_resp = requests.post('https://sim.deepdrive.io/job/status',
-                                json={'job_id': job_id})
+    status_resp = get_session().post(f'{DEEPDRIVE_SIM_HOST}/job/status',
+                                     json={'job_id': job_id})
     if not status_resp.ok:
         raise RuntimeError('Error getting job status')
     return status_resp
@@ -219,28 +364,12 @@ def test_handle_job_results():
 
 
 def get_file_from_github(repo, filename, ref=None):
-    """@:param filename: relative path to file in repo"""
-    try:
-        args = [filename]
-        if ref is not None:
-            args.append(ref)
-        contents = repo.get_contents(*args)
-        ret_sha = contents.sha
-        content_str = contents.decoded_content.decode('utf-8')
-    except UnknownObjectException:
-        log.error(f'Unable to find {filename} in {repo.html_url}')
-        content_str = ''
-        ret_sha = ''
-    ret_content = get_str_or_box(content_str, filename)
-    return ret_content, ret_sha
-
-
-def get_str_or_box(content_str, filename):
-    if filename.endswith('.json') and content_str:
-        ret = Box(json.loads(content_str))
-    else:
-        ret = content_str
-    return ret
+    """
+    @:param filename: relative path to file in repo
+    :return: (content, blob sha)
+    """
+    return get_file_and_sha_from_github(repo, filename, ref)
+
 
 def create_pull_request(pull: Box, repo_full_name: str, token: str) -> \
         requests.Response:
@@ -251,8 +380,8 @@ def create_pull_request(pull: Box, repo_full_name: str, token: str) -> \
         Accept='application/vnd.github.shadow-cat-preview+json',
         Authorization=f'token {token}'
     )
-    resp = requests.post(
-        f'https://api.github.com/repos/{repo_full_name}/pulls',
+    resp = github_request(
+        'POST', f'{GITHUB_API_URL}/repos/{repo_full_name}/pulls',
         json=pull.to_dict(),
         headers=headers)
     log.info(f'Created pull request #{resp.json()["number"]} on '
@@ -262,9 +391,9 @@ def create_pull_request(pull: Box, repo_full_name: str, token: str) -> \
 
 def get_head_commit(full_repo_name: str, token: str, branch: str = 'master'):
     headers = dict(Authorization=f'token {token}')
-    resp = requests.get(
-        f'https://api.github.com/repos/'
-        f'{full_repo_name}/git/refs/heads/{branch}',
+    resp = github_request(
+        'GET',
+        f'{GITHUB_API_URL}/repos/{full_repo_name}/git/refs/heads/{branch}',
         headers=headers)
     ret = resp.json()['object']['sha']
     return ret
@@ -1,8 +1,7 @@
-import inspect
 import os
 import sys
+from typing import Optional
 
-import github
 from botleague_helpers import VERSION
 from botleague_helpers.crypto import decrypt_symmetric, decrypt_db_key
 
@@ -11,6 +10,8 @@ class Config:
     # Constants
     should_use_firestore = os.environ.get(
         'SHOULD_USE_FIRESTORE', 'true') == 'true'
+    # Persistent local db used when SHOULD_USE_FIRESTORE is false
+    sqlite_db_path = os.environ.get('SQLITE_DB_PATH')
     is_test = 'IS_TEST' in os.environ
     should_gen_key = 'should_gen_leaderboard'
     token_name = 'LEADERBOARD_GITHUB_TOKEN'
@@ -69,15 +70,39 @@ class Config:
             self._firebase_initialized = True
 
 
+TEST_PREFIX = 'test_'
+
+# Set with override_test_name() to skip walking the call stack
+_test_name_override: Optional[str] = None
+
+
 def get_test_name_from_callstack() -> str:
-    ret = ''
-    for level in inspect.stack():
-        fn = level.function
-        test_prefix = 'test_'
-        if fn.startswith(test_prefix):
-            test_name = fn[len(test_prefix):]
-            return test_name
-    return ret
+    """
+    :return: Name of the innermost test_ function on the call stack without
+        its prefix, or ''. This is on the logging hot path, so we only look
+        at code names rather than using inspect.stack(), which reads source
+        files for every frame.
+    """
+    if _test_name_override is not None:
+        return _test_name_override
+    frame = sys._getframe(1)
+    while frame is not None:
+        fn = frame.f_code.co_name
+        if fn.startswith(TEST_PREFIX):
+            return fn[len(TEST_PREFIX):]
+        frame = frame.f_back
+    return ''
+
+
+def override_test_name(test_name: Optional[str]):
+    """
+    :param test_name: Test name for get_test_name_from_callstack to return
+        in this process regardless of the call stack. '' means never in a
+        test, None goes back to walking the call stack.
+    """
+    global _test_name_override
+    _test_name_override = test_name
+
 
 blconfig = Config()
 
@@ -90,6 +115,7 @@ def in_test() -> bool:
     return ret
 
 if 'GITHUB_DEBUG' in os.environ:
+    import github
     github.enable_console_debug_logging()
 
 def activate_test_mode():
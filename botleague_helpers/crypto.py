@@ -1,102 +1,469 @@
-import sys
+import argparse
+import base64
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from typing import Any, Callable, Dict, List
 
 from box import Box
 from loguru import logger as log
 
+from botleague_helpers.cache import CachePolicy, LRUCache
+
 POSTFIX = '_encrypted'
 DEFAULT_DB_NAME = 'secrets'
 
-def encrypt_db_key(unencrypted_value, key, db=None):
+DEFAULT_PROJECT_ID = 'silken-impulse-217423'
+DEFAULT_LOCATION_ID = 'global'
+DEFAULT_KEY_RING_ID = 'deepdrive'
+DEFAULT_CRYPTO_KEY_ID = 'deepdrive'
+
+# Max concurrent KMS requests when encrypting / decrypting dict fields
+MAX_KMS_WORKERS = 8
+
+# Seconds to keep decrypted secrets in memory
+SECRET_CACHE_TTL = 60 * 10
+secret_cache = LRUCache(CachePolicy(ttl=SECRET_CACHE_TTL, max_entries=256))
+
+# Envelope encrypted secrets store their KMS encrypted data key here
+ENVELOPE_KEY_FIELD = 'wrapped_data_key'
+
+# (project, location, key ring, key) => (client, crypto key name)
+_kms_clients = {}
+_kms_clients_lock = threading.Lock()
+_kms_clients_pid = os.getpid()
+
+
+def _create_kms_client():
+    from google.cloud import kms_v1
+    return kms_v1.KeyManagementServiceClient()
+
+
+# Swap out with use_fake_kms() to run without GCP
+kms_client_factory = _create_kms_client
+
+
+def get_kms_client(project_id=DEFAULT_PROJECT_ID,
+                   location_id=DEFAULT_LOCATION_ID,
+                   key_ring_id=DEFAULT_KEY_RING_ID,
+                   crypto_key_id=DEFAULT_CRYPTO_KEY_ID):
+    """
+    Lazily create one KMS client per process and key, so we only pay for
+    the gRPC channel, auth and TLS setup once.
+    :return: (client, crypto key resource name)
+    """
+    global _kms_clients_pid
+    cache_key = (project_id, location_id, key_ring_id, crypto_key_id)
+    with _kms_clients_lock:
+        if _kms_clients_pid != os.getpid():
+            # gRPC channels can't be shared with a forked child
+            _kms_clients.clear()
+            _kms_clients_pid = os.getpid()
+        if cache_key not in _kms_clients:
+            client = kms_client_factory()
+            name = client.crypto_key_path_path(*cache_key)
+            _kms_clients[cache_key] = (client, name)
+        return _kms_clients[cache_key]
+
+
+def reset_kms_clients():
+    with _kms_clients_lock:
+        _kms_clients.clear()
+
+
+def _reset_kms_clients_after_fork():
+    global _kms_clients_lock, _kms_clients_pid
+    # The lock may have been held by another thread when we forked
+    _kms_clients_lock = threading.Lock()
+    _kms_clients.clear()
+    _kms_clients_pid = os.getpid()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_kms_clients_after_fork)
+
+
+class FakeKMSClient:
+    """
+    Offline stand-in for kms_v1.KeyManagementServiceClient that simulates
+    client setup and request latency, i.e. for benchmarks. NOT encryption.
+    """
+    def __init__(self, setup_seconds=0., request_seconds=0.):
+        time.sleep(setup_seconds)
+        self.request_seconds = request_seconds
+        self.num_requests = 0
+
+    @staticmethod
+    def crypto_key_path_path(project_id, location_id, key_ring_id,
+                             crypto_key_id):
+        return f'projects/{project_id}/locations/{location_id}/' \
+            f'keyRings/{key_ring_id}/cryptoKeys/{crypto_key_id}'
+
+    def encrypt(self, name, plaintext: bytes) -> Box:
+        self.num_requests += 1
+        time.sleep(self.request_seconds)
+        return Box(ciphertext=base64.b64encode(plaintext))
+
+    def decrypt(self, name, ciphertext: bytes) -> Box:
+        self.num_requests += 1
+        time.sleep(self.request_seconds)
+        return Box(plaintext=base64.b64decode(ciphertext))
+
+
+def use_fake_kms(setup_seconds=0., request_seconds=0.):
+    global kms_client_factory
+    kms_client_factory = partial(FakeKMSClient, setup_seconds, request_seconds)
+    reset_kms_clients()
+
+
+def run_concurrently(fns: List[Callable[[], Any]],
+                     max_workers=MAX_KMS_WORKERS) -> list:
+    """Call each fn on a bounded thread pool, returning results in order"""
+    if len(fns) <= 1 or max_workers <= 1:
+        return [fn() for fn in fns]
+    with ThreadPoolExecutor(min(max_workers, len(fns))) as executor:
+        return list(executor.map(lambda fn: fn(), fns))
+
+
+def map_fields(fn, value: dict, max_workers=MAX_KMS_WORKERS) -> dict:
+    """Apply fn to each value in the dict, concurrently"""
+    results = run_concurrently([partial(fn, v) for v in value.values()],
+                               max_workers)
+    return dict(zip(value.keys(), results))
+
+
+def encrypt_values(values: Dict[str, Any], envelope=False,
+                   max_workers=MAX_KMS_WORKERS) -> Dict[str, Any]:
+    """
+    Encrypt several secrets with all their KMS requests sharing one
+    bounded pool.
+    :param values: db key => str or dict of str
+    :return: db key => encrypted value to store
+    """
+    tasks = []  # (key, field or None, fn)
+    for key, value in values.items():
+        if envelope:
+            tasks.append((key, None, partial(envelope_encrypt, value, key)))
+        elif isinstance(value, dict):
+            for field, v in value.items():
+                tasks.append((key, field, partial(encrypt_symmetric, v)))
+        else:
+            tasks.append((key, None, partial(encrypt_symmetric, value)))
+    results = run_concurrently([fn for _, _, fn in tasks], max_workers)
+    ret = {k: {} for k, v in values.items() if isinstance(v, dict)}
+    for (key, field, _), result in zip(tasks, results):
+        if field is None:
+            ret[key] = result
+        else:
+            ret[key][field] = result
+    return ret
+
+
+def decrypt_values(encrypted_values: Dict[str, Any],
+                   max_workers=MAX_KMS_WORKERS) -> Dict[str, Any]:
+    """
+    Inverse of encrypt_values, also handling secrets stored as
+    Box(token=ciphertext)
+    """
+    tasks = []  # (key, field or None, fn)
+    dict_keys = set()
+    for key, value in encrypted_values.items():
+        if isinstance(value, dict):
+            if ENVELOPE_KEY_FIELD in value:
+                tasks.append((key, None, partial(envelope_decrypt, value, key)))
+            elif 'token' in value:
+                tasks.append((key, None,
+                              partial(decrypt_symmetric, value['token'])))
+            else:
+                dict_keys.add(key)
+                for field, v in value.items():
+                    tasks.append((key, field, partial(decrypt_symmetric, v)))
+        else:
+            tasks.append((key, None, partial(decrypt_symmetric, value)))
+    results = run_concurrently([fn for _, _, fn in tasks], max_workers)
+    ret = {k: Box() for k in dict_keys}
+    for (key, field, _), result in zip(tasks, results):
+        if field is None:
+            ret[key] = result
+        else:
+            ret[key][field] = result
+    return ret
+
+
+def encrypt_db_key(unencrypted_value, key, db=None, envelope=False):
+    """
+    :param envelope: Encrypt fields locally with a fresh AES-GCM data key and
+        store only that key encrypted with KMS, so decrypting takes one KMS
+        call however many fields there are
+    """
     from botleague_helpers.db import get_db
     db = db or get_db(DEFAULT_DB_NAME, force_firestore_db=True)
     key = f'{key}{POSTFIX}'
-    if isinstance(unencrypted_value, dict):
-        encrypted_value = dict()
-        for k, v in unencrypted_value.items():
-            encrypted_value[k] = encrypt_symmetric(v)
-        db.set(key, encrypted_value)
-    else:
-        db.set(key, encrypt_symmetric(unencrypted_value))
+    db.set(key, encrypt_values({key: unencrypted_value}, envelope)[key])
+    invalidate_secret(key, db)
 
 
-def decrypt_db_key(key, db=None):
+def decrypt_db_key(key, db=None, use_cache=True):
+    """
+    :param use_cache: Return the value decrypted within the last
+        SECRET_CACHE_TTL seconds in this process if we have it
+    """
     from botleague_helpers.db import get_db
-    db = db or get_db(DEFAULT_DB_NAME, force_firestore_db=True)
     if not key.endswith(POSTFIX):
         key = f'{key}{POSTFIX}'
-    encrypted_value = db.get(key)
-    if isinstance(encrypted_value, Box):
-        if 'token' in encrypted_value:
-            encrypted_value = encrypted_value.token
-            ret = decrypt_symmetric(encrypted_value)
+    cache_key = get_secret_cache_key(key, db)
+    if use_cache:
+        found, ret = secret_cache.get(cache_key)
+        if found:
+            return ret
+    db = db or get_db(DEFAULT_DB_NAME, force_firestore_db=True)
+    ret = decrypt_values({key: db.get(key)})[key]
+    secret_cache.put(cache_key, ret)
+    return ret
+
+
+def encrypt_secrets(secrets: Dict[str, Any], db=None, envelope=False,
+                    max_workers=MAX_KMS_WORKERS, timings: Box = None):
+    """
+    Encrypt and store many secrets at once, i.e. from a JSON file.
+
+    :param secrets: Secret name => str or dict of str
+    :param timings: [Optional] Box to fill with seconds spent per stage
+    """
+    from botleague_helpers.db import get_db
+    timings = Box() if timings is None else timings
+    with timed('connect', timings):
+        db = db or get_db(DEFAULT_DB_NAME, force_firestore_db=True)
+    values = {get_secret_key(name): v for name, v in secrets.items()}
+    with timed('kms', timings):
+        encrypted = encrypt_values(values, envelope, max_workers)
+    with timed('write', timings):
+        db.set_many(encrypted)
+    for key in encrypted:
+        invalidate_secret(key, db)
+
+
+def decrypt_secrets(names: List[str] = None, db=None,
+                    max_workers=MAX_KMS_WORKERS,
+                    timings: Box = None) -> Box:
+    """
+    :param names: Secrets to decrypt, defaults to all of them
+    :param timings: [Optional] Box to fill with seconds spent per stage
+    :return: Box of secret name => decrypted value
+    """
+    from botleague_helpers.db import get_db
+    timings = Box() if timings is None else timings
+    with timed('connect', timings):
+        db = db or get_db(DEFAULT_DB_NAME, force_firestore_db=True)
+    with timed('read', timings):
+        if names is None:
+            keys = [k for k in db.keys() if k.endswith(POSTFIX)]
         else:
-            ret = Box()
-            for k, v in encrypted_value.items():
-                ret[k] = decrypt_symmetric(v)
+            keys = [get_secret_key(name) for name in names]
+        encrypted = db.get_many(keys)
+    with timed('kms', timings):
+        decrypted = decrypt_values(encrypted, max_workers)
+    return Box({key[:-len(POSTFIX)]: value
+                for key, value in decrypted.items()})
+
+
+def rotate_secrets(db=None, envelope=False, max_workers=MAX_KMS_WORKERS,
+                   timings: Box = None):
+    """
+    Re-encrypt all secrets, i.e. with the KMS key's new primary version
+    after rotating it, or to switch to envelope encryption.
+    """
+    timings = Box() if timings is None else timings
+    decrypt_timings = Box()
+    secrets = decrypt_secrets(db=db, max_workers=max_workers,
+                              timings=decrypt_timings)
+    encrypt_timings = Box()
+    encrypt_secrets(secrets, db=db, envelope=envelope,
+                    max_workers=max_workers, timings=encrypt_timings)
+    for stage, seconds in decrypt_timings.items():
+        timings[f'decrypt_{stage}'] = seconds
+    for stage, seconds in encrypt_timings.items():
+        timings[f'encrypt_{stage}'] = seconds
+    return list(secrets)
+
+
+@contextmanager
+def timed(stage: str, timings: Box):
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0) + time.time() - start
+
+
+def get_secret_key(name: str) -> str:
+    return name if name.endswith(POSTFIX) else f'{name}{POSTFIX}'
+
+
+def get_secret_cache_key(key, db=None) -> tuple:
+    if not key.endswith(POSTFIX):
+        key = f'{key}{POSTFIX}'
+    collection_name = db.collection_name if db else DEFAULT_DB_NAME
+    return collection_name, key
+
+
+def invalidate_secret(key=None, db=None):
+    """Forget cached decrypted secret(s). key=None forgets them all."""
+    if key is None:
+        secret_cache.clear()
     else:
-        ret = decrypt_symmetric(encrypted_value)
+        secret_cache.invalidate(get_secret_cache_key(key, db))
+
+
+def envelope_encrypt(unencrypted_value, key) -> Box:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    data_key = AESGCM.generate_key(bit_length=256)
+    aes = AESGCM(data_key)
+
+    def encrypt_field(field, plaintext: str) -> bytes:
+        nonce = os.urandom(12)
+        # Bind ciphertexts to their place so they can't be swapped around
+        aad = f'{key}/{field}'.encode()
+        return nonce + aes.encrypt(nonce, plaintext.encode(), aad)
+
+    ret = Box({ENVELOPE_KEY_FIELD: encrypt_symmetric_bytes(data_key)})
+    if isinstance(unencrypted_value, dict):
+        ret.fields = {k: encrypt_field(k, v)
+                      for k, v in unencrypted_value.items()}
+    else:
+        ret.value = encrypt_field('', unencrypted_value)
     return ret
 
 
-def encrypt_symmetric(plaintext, project_id='silken-impulse-217423',
-                      location_id='global',
-                      key_ring_id='deepdrive', crypto_key_id='deepdrive'):
+def envelope_decrypt(encrypted_value: Box, key):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    aes = AESGCM(decrypt_symmetric_bytes(encrypted_value[ENVELOPE_KEY_FIELD]))
+
+    def decrypt_field(field, ciphertext: bytes) -> str:
+        nonce, ciphertext = ciphertext[:12], ciphertext[12:]
+        aad = f'{key}/{field}'.encode()
+        return aes.decrypt(nonce, ciphertext, aad).decode()
+
+    if 'fields' in encrypted_value:
+        return Box({k: decrypt_field(k, v)
+                    for k, v in encrypted_value.fields.items()})
+    else:
+        return decrypt_field('', encrypted_value.value)
+
+
+def encrypt_symmetric(plaintext, project_id=DEFAULT_PROJECT_ID,
+                      location_id=DEFAULT_LOCATION_ID,
+                      key_ring_id=DEFAULT_KEY_RING_ID,
+                      crypto_key_id=DEFAULT_CRYPTO_KEY_ID):
     """Encrypts input plaintext data using the provided symmetric CryptoKey."""
 
-    from google.cloud import kms_v1
+    return encrypt_symmetric_bytes(plaintext.encode(), project_id,
+                                   location_id, key_ring_id, crypto_key_id)
 
-    # Creates an API client for the KMS API.
-    client = kms_v1.KeyManagementServiceClient()
 
-    # The resource name of the CryptoKey.
-    name = client.crypto_key_path_path(project_id, location_id, key_ring_id,
-                                       crypto_key_id)
+def encrypt_symmetric_bytes(plaintext: bytes, project_id=DEFAULT_PROJECT_ID,
+                            location_id=DEFAULT_LOCATION_ID,
+                            key_ring_id=DEFAULT_KEY_RING_ID,
+                            crypto_key_id=DEFAULT_CRYPTO_KEY_ID) -> bytes:
+    # Shared API client for the KMS API and resource name of the CryptoKey.
+    client, name = get_kms_client(project_id, location_id, key_ring_id,
+                                  crypto_key_id)
 
     # Use the KMS API to encrypt the data.
-    response = client.encrypt(name, plaintext.encode())
+    response = client.encrypt(name, plaintext)
     return response.ciphertext
 
 
-def decrypt_symmetric(ciphertext, project_id='silken-impulse-217423',
-                      location_id='global',
-                      key_ring_id='deepdrive', crypto_key_id='deepdrive'):
+def decrypt_symmetric(ciphertext, project_id=DEFAULT_PROJECT_ID,
+                      location_id=DEFAULT_LOCATION_ID,
+                      key_ring_id=DEFAULT_KEY_RING_ID,
+                      crypto_key_id=DEFAULT_CRYPTO_KEY_ID):
     """Decrypts input ciphertext using the provided symmetric CryptoKey."""
 
-    from google.cloud import kms_v1
+    ret = decrypt_symmetric_bytes(ciphertext, project_id, location_id,
+                                  key_ring_id, crypto_key_id).decode()
+    return ret
 
-    # Creates an API client for the KMS API.
-    client = kms_v1.KeyManagementServiceClient()
 
-    # The resource name of the CryptoKey.
-    name = client.crypto_key_path_path(project_id, location_id, key_ring_id,
-                                       crypto_key_id)
+def decrypt_symmetric_bytes(ciphertext, project_id=DEFAULT_PROJECT_ID,
+                            location_id=DEFAULT_LOCATION_ID,
+                            key_ring_id=DEFAULT_KEY_RING_ID,
+                            crypto_key_id=DEFAULT_CRYPTO_KEY_ID) -> bytes:
+    # Shared API client for the KMS API and resource name of the CryptoKey.
+    client, name = get_kms_client(project_id, location_id, key_ring_id,
+                                  crypto_key_id)
     # Use the KMS API to decrypt the data.
     response = client.decrypt(name, ciphertext)
-    ret = response.plaintext.decode()
-    return ret
+    return response.plaintext
 
 
-def main():
-    if '--decrypt' in sys.argv:
-        if len(sys.argv) > 2:
-            name = sys.argv[-1]
-        else:
-            name = input('Secret name? ')
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Encrypt and decrypt secrets stored in Firestore')
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--decrypt', nargs='?', const='', metavar='NAME',
+                      help='Decrypt one secret, prompting for NAME if '
+                           'not given')
+    mode.add_argument('--encrypt', nargs='*', metavar='NAME VALUE',
+                      help='Encrypt one secret, prompting for NAME and '
+                           'VALUE if not given')
+    mode.add_argument('--encrypt-file', metavar='PATH',
+                      help='Encrypt each name => value in a JSON file')
+    mode.add_argument('--decrypt-all', action='store_true',
+                      help='Print all secrets as JSON')
+    mode.add_argument('--rotate', action='store_true',
+                      help='Re-encrypt all secrets, i.e. after rotating '
+                           'the KMS key')
+    parser.add_argument('--envelope', action='store_true',
+                        help='Use envelope encryption when encrypting')
+    args = parser.parse_args(argv)
+    if args.encrypt is not None and len(args.encrypt) not in [0, 2]:
+        parser.error('--encrypt takes NAME VALUE or nothing to be prompted')
+    return args
+
+
+def main(argv: List[str] = None):
+    args = parse_args(argv)
+    timings = Box()
+    if args.encrypt_file:
+        with open(args.encrypt_file) as secrets_file:
+            secrets = json.load(secrets_file)
+        encrypt_secrets(secrets, envelope=args.envelope, timings=timings)
+        log.success(f'Encrypted {len(secrets)} secrets')
+    elif args.decrypt_all:
+        secrets = decrypt_secrets(timings=timings)
+        print(json.dumps(secrets.to_dict(), indent=2, sort_keys=True))
+    elif args.rotate:
+        names = rotate_secrets(envelope=args.envelope, timings=timings)
+        log.success(f'Rotated {len(names)} secrets: {names}')
+    elif args.decrypt is not None:
+        name = args.decrypt or input('Secret name? ')
         print(decrypt_db_key(name))
-    elif '--encrypt' in sys.argv:
-        if len(sys.argv) > 2:
-            name = sys.argv[-2]
-            value = sys.argv[-1]
+    elif args.encrypt is not None:
+        if args.encrypt:
+            name, value = args.encrypt
         else:
             name = input('Secret name? ')
-            value= input('Secret value? ')
-        encrypt_db_key(value, name)
+            value = input('Secret value? ')
+        encrypt_db_key(value, name, envelope=args.envelope)
+    for stage, seconds in timings.items():
+        log.info(f'{stage}: {seconds:.3f}s')
 
 
 # Usage
 # Decrypt:
 #   python crypto.py --decrypt MYSECRETNAME
-# Encrypt:
-#   python crypto.py --encrypt NEW_NAME MYVALUE
+# Encrypt, optionally with envelope encryption:
+#   python crypto.py --encrypt NEW_NAME MYVALUE [--envelope]
+# Encrypt many from a JSON object of name => value:
+#   python crypto.py --encrypt-file secrets.json [--envelope]
+# Decrypt all to stdout:
+#   python crypto.py --decrypt-all
+# Re-encrypt all, i.e. after rotating the KMS key:
+#   python crypto.py --rotate [--envelope]
 if __name__ == '__main__':
     main()
@@ -1,38 +1,129 @@
 from __future__ import print_function
 
+import base64
+import json
+import os
+import sqlite3
 import sys
+import threading
 import time
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-from typing import Any, Generator
+from typing import Any, Callable, Dict, Generator, Iterable, List, Tuple
 
 from box import BoxList, Box
 
+from botleague_helpers import indexes
+from botleague_helpers.cache import CachePolicy, LRUCache
 from botleague_helpers.config import blconfig
 from botleague_helpers.config import get_test_name_from_callstack
-from google.cloud import firestore
 
 DEFAULT_COLLECTION = 'simple_key_value_store'
 
+# Firestore allows at most 500 writes per batch / transaction
+# https://firebase.google.com/docs/firestore/quotas#writes_and_transactions
+MAX_BATCH_SIZE = 500
+
+# Return from a DB.transact function to skip writing
+UNCHANGED = object()
+
+# Seconds to wait on another process' write lock before giving up
+SQLITE_BUSY_TIMEOUT = 30
+
+# Keys of the JSON objects that stand in for values JSON can't hold, but
+# Firestore stores natively
+SQLITE_BYTES_TAG = '__bytes__'
+SQLITE_DATETIME_TAG = '__datetime__'
+
+# Python type => SQLite json_type()s it can compare equal to
+SQLITE_JSON_TYPES = {
+    bool: ['true', 'false'],
+    int: ['integer', 'real'],
+    float: ['integer', 'real'],
+    str: ['text'],
+}
+
+
+def cas_matches(current, expected) -> bool:
+    """
+    Whether compare_and_swap should swap. A missing document matches an
+    empty value, i.e. what get() returned for it, whether None or {}.
+    """
+    if current is None or current == {}:
+        return expected is None or expected == {}
+    return current == expected
+
 
 class DB:
     db = None
     collection = None
 
-    def __init__(self, collection_name, use_boxes):
+    def __init__(self, collection_name, use_boxes, cache: CachePolicy = None):
         self.collection_name = collection_name or DEFAULT_COLLECTION
         self.use_boxes = use_boxes
+        # Read-through cache. Only writes made through this instance
+        # invalidate it, so use a ttl for keys that others write.
+        self.cache = LRUCache(cache) if cache else None
 
     def get(self, key) -> Any:
-        ret = self._get(key)
+        if self.cache is not None:
+            found, ret = self.cache.get(key)
+            if not found:
+                ret = self._get(key)
+                self.cache.put(key, ret)
+        else:
+            ret = self._get(key)
         ret = self._deserialize(ret)
         return ret
 
     def set(self, key, value) -> Any:
         value = self._serialize(value)
-        return self._set(key, value)
+        ret = self._set(key, value)
+        self._cache_written(key, value)
+        return ret
 
     def delete(self, key):
-        return self._delete(key)
+        ret = self._delete(key)
+        self._cache_invalidate(key)
+        return ret
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """
+        Get several keys in as few round trips as the backend allows.
+        :return: dict of key => value, with the same values get() would return
+        """
+        keys = list(keys)
+        ret = {}
+        if self.cache is not None:
+            for key in keys:
+                found, value = self.cache.get(key)
+                if found:
+                    ret[key] = value
+        missing = [k for k in keys if k not in ret]
+        if missing:
+            fetched = self._get_many(missing)
+            if self.cache is not None:
+                for k, v in fetched.items():
+                    self.cache.put(k, v)
+            ret.update(fetched)
+        ret = {k: self._deserialize(ret[k]) for k in keys}
+        return ret
+
+    def set_many(self, mapping: Dict[str, Any]):
+        mapping = {k: self._serialize(v) for k, v in mapping.items()}
+        ret = self._set_many(mapping)
+        for k, v in mapping.items():
+            self._cache_written(k, v)
+        return ret
+
+    def delete_many(self, keys: Iterable[str]):
+        keys = list(keys)
+        ret = self._delete_many(keys)
+        for key in keys:
+            self._cache_invalidate(key)
+        return ret
 
     def compare_and_swap(self, key, expected_current_value, new_value) -> bool:
         """
@@ -42,15 +133,96 @@ class DB:
         """
         new_value = self._serialize(new_value)
         expected_current_value = self._serialize(expected_current_value)
-        return self._compare_and_swap(key, expected_current_value, new_value)
+        ret = self._compare_and_swap(key, expected_current_value, new_value)
+        if ret:
+            self._cache_written(key, new_value)
+        else:
+            # Someone else changed it, so our cached value may be stale
+            self._cache_invalidate(key)
+        return ret
 
     cas = compare_and_swap
 
-    def where(self, *args) -> Generator:
-        for item in self._where(*args):
+    def transact(self, key, fn: Callable[[Any], Any]) -> Any:
+        """
+        Atomically read key and write fn(current_value) in one transaction.
+        fn may return UNCHANGED to skip the write, and may be called more
+        than once if the transaction is retried, so it shouldn't have side
+        effects or touch the db.
+
+        :return: The value fn was (last) called with
+        """
+        last_read = Box(value=None)
+
+        def raw_fn(raw_value):
+            current = self._deserialize(raw_value)
+            last_read.value = current
+            new_value = fn(current)
+            if new_value is UNCHANGED:
+                return UNCHANGED
+            return self._serialize(new_value)
+
+        raw_value, new_value = self._transact(key, raw_fn)
+        if new_value is UNCHANGED:
+            if self.cache is not None:
+                self.cache.put(key, raw_value)
+        else:
+            self._cache_written(key, new_value)
+        return last_read.value
+
+    def update_if(self, key, predicate: Callable[[Any], bool],
+                  new_value) -> bool:
+        """
+        Atomically set key to new_value if predicate(current_value)
+        :return: Whether the value was updated
+        """
+        updated = Box(value=False)
+
+        def fn(current):
+            updated.value = bool(predicate(current))
+            return new_value if updated.value else UNCHANGED
+
+        self.transact(key, fn)
+        return updated.value
+
+    def where(self, field: str, op: str, value,
+              limit: int = None,
+              order_by: str = None,
+              descending: bool = False,
+              start_after: dict = None,
+              select: List[str] = None,
+              page_size: int = None) -> Generator:
+        """
+        Lazily yield documents where field op value, i.e.
+        db.where('score', '>', 10, order_by='score', limit=100)
+
+        :param limit: Max number of documents to yield
+        :param order_by: Field to order by, else ordered by key
+        :param descending: Reverse order_by
+        :param start_after: Cursor from the previous page, i.e. the last
+            document yielded, containing the order_by field
+        :param select: Only return these fields of each document
+        :param page_size: Fetch this many documents per round trip while
+            streaming
+        """
+        options = Box(limit=limit, order_by=order_by, descending=descending,
+                      start_after=start_after, select=select,
+                      page_size=page_size)
+        for item in self._where(field, op, value, options):
             yield self._deserialize(item)
 
-    def _where(self, *args):
+    def _where(self, field, op, value, options: Box) -> Generator:
+        raise NotImplementedError()
+
+    def watch(self, key) -> 'Watcher':
+        """
+        :return: Watcher whose wait() returns early when key changes, where
+            the backend supports change notifications
+        """
+        return Watcher()
+
+    def keys(self) -> List[str]:
+        """All keys in the collection"""
         raise NotImplementedError()
 
     def delete_all_test_data(self):
@@ -59,6 +231,14 @@ class DB:
     def _compare_and_swap(self, key, expected_current_value, new_value) -> bool:
         raise NotImplementedError()
 
+    def _transact(self, key, fn) -> Tuple[Any, Any]:
+        """
+        Run fn on the raw current value and write its result unless
+        it's UNCHANGED, atomically.
+        :return: (raw value passed to fn, value returned by fn)
+        """
+        raise NotImplementedError()
+
     def _get(self, key) -> Any:
         raise NotImplementedError()
 
@@ -68,26 +248,229 @@ class DB:
     def _delete(self, key) -> Any:
         raise NotImplementedError()
 
-    def _serialize(self, value):
-        if self.use_boxes:
-            if isinstance(value, BoxList):
-                value = value.to_list()
-            elif isinstance(value, Box):
-                value = value.to_dict()
+    def _get_many(self, keys: List[str]) -> Dict[str, Any]:
+        return {k: self._get(k) for k in keys}
+
+    def _set_many(self, mapping: Dict[str, Any]) -> Any:
+        return [self._set(k, v) for k, v in mapping.items()]
+
+    def _delete_many(self, keys: List[str]) -> Any:
+        return [self._delete(k) for k in keys]
+
+    def _cache_written(self, key, value):
+        if self.cache is not None:
+            self.cache.put(key, self._stored_form(key, value))
+
+    def _cache_invalidate(self, key):
+        if self.cache is not None:
+            self.cache.invalidate(key)
+
+    def _stored_form(self, key, value) -> Any:
+        """What _get(key) returns after _set(key, value)"""
         return value
 
+    def _serialize(self, value):
+        return serialize(value, self.use_boxes)
+
     def _deserialize(self, ret):
-        if self.use_boxes:
-            if isinstance(ret, list):
-                ret = BoxList(ret)
-            elif isinstance(ret, dict):
-                ret = Box(ret)
+        return deserialize(ret, self.use_boxes)
+
+
+def serialize(value, use_boxes: bool):
+    if use_boxes:
+        if isinstance(value, BoxList):
+            value = value.to_list()
+        elif isinstance(value, Box):
+            value = value.to_dict()
+    return value
+
+
+def deserialize(ret, use_boxes: bool):
+    if use_boxes:
+        if isinstance(ret, list):
+            ret = BoxList(ret)
+        elif isinstance(ret, dict):
+            ret = Box(ret)
+    return ret
+
+
+class Watcher:
+    """
+    Waits for changes to a key. This base version can't be notified, so
+    wait() just sleeps for the timeout, leaving callers to poll.
+    """
+    def wait(self, timeout: float) -> bool:
+        """:return: True if the key changed, False on timeout"""
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FirestoreWatcher(Watcher):
+    def __init__(self, doc_ref):
+        self._changed = threading.Event()
+        self._got_initial_snapshot = False
+        self._watch = doc_ref.on_snapshot(self._on_snapshot)
+
+    def _on_snapshot(self, snapshots, changes, read_time):
+        if not self._got_initial_snapshot:
+            # The first callback is the current state, not a change
+            self._got_initial_snapshot = True
+        else:
+            self._changed.set()
+
+    def wait(self, timeout: float) -> bool:
+        ret = self._changed.wait(timeout)
+        self._changed.clear()
         return ret
 
+    def close(self):
+        self._watch.unsubscribe()
+
+
+class LocalChangeNotifier:
+    """
+    Per-collection change versions that DBLocal watchers wait on. Keys are
+    only tracked while something is watching them.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.versions = {}
+        self.num_watchers = {}
+        self.listeners = {}
+
+    def changed(self, key):
+        """
+        Call after releasing the key's lock, as listeners may use the db
+        """
+        # Skip the condition lock for the common case of no one watching
+        if self.num_watchers.get(key):
+            with self.condition:
+                self.versions[key] = self.versions.get(key, 0) + 1
+                self.condition.notify_all()
+                listeners = list(self.listeners.get(key, ()))
+            for listener in listeners:
+                listener()
+
+    def subscribe(self, key, listener: Callable[[], Any]):
+        """Call listener, from the writing thread, when key changes"""
+        with self.condition:
+            self.add_watcher(key)
+            self.listeners.setdefault(key, set()).add(listener)
+
+    def unsubscribe(self, key, listener: Callable[[], Any]):
+        with self.condition:
+            listeners = self.listeners[key]
+            listeners.discard(listener)
+            if not listeners:
+                del self.listeners[key]
+            self.remove_watcher(key)
+
+    def add_watcher(self, key) -> int:
+        """:return: The key's current version"""
+        with self.condition:
+            self.num_watchers[key] = self.num_watchers.get(key, 0) + 1
+            return self.versions.get(key, 0)
+
+    def remove_watcher(self, key):
+        with self.condition:
+            self.num_watchers[key] -= 1
+            if not self.num_watchers[key]:
+                del self.num_watchers[key]
+                self.versions.pop(key, None)
+
+
+class LocalWatcher(Watcher):
+    def __init__(self, notifier: LocalChangeNotifier, key):
+        self.notifier = notifier
+        self.key = key
+        self.version = notifier.add_watcher(key)
+
+    def wait(self, timeout: float) -> bool:
+        versions = self.notifier.versions
+        with self.notifier.condition:
+            ret = self.notifier.condition.wait_for(
+                lambda: versions.get(self.key, 0) != self.version, timeout)
+            self.version = versions.get(self.key, 0)
+        return ret
+
+    def close(self):
+        self.notifier.remove_watcher(self.key)
+
+
+class FirestorePager:
+    """
+    Builds the queries for DB.where on Firestore, continuing each page from
+    the last snapshot of the one before. Shared by the sync and async
+    backends, which stream each page_query and pass the snapshots to add().
+    """
+    def __init__(self, collection, field, op, value, options: Box):
+        from google.cloud import firestore
+        self.options = options
+        self.select = options.select
+        if self.select and options.order_by and \
+                options.order_by not in self.select:
+            # Cursors need the order_by field, which we strip before
+            # yielding
+            self.select = list(self.select) + [options.order_by]
+        query = collection.where(field, op, value)
+        if self.select:
+            query = query.select(self.select)
+        if options.order_by:
+            direction = firestore.Query.DESCENDING if options.descending \
+                else firestore.Query.ASCENDING
+            query = query.order_by(options.order_by, direction=direction)
+        if options.start_after:
+            query = query.start_after(options.start_after)
+        self.query = query
+        self.remaining = options.limit
+        self.page_size = options.page_size or self.remaining
+        self.page_limit = None
+        self.last = None
+        self.num_in_page = 0
+        self.started = False
+
+    def next_page(self):
+        """:return: Query for the next page, or None when we're done"""
+        if self.started:
+            if self.remaining is not None:
+                self.remaining -= self.num_in_page
+            if self.page_limit is None or self.num_in_page < self.page_limit:
+                return None
+            self.query = self.query.start_after(self.last)
+        self.started = True
+        if self.remaining == 0:
+            return None
+        self.page_limit = self.page_size
+        if self.remaining is not None:
+            self.page_limit = min(self.page_size, self.remaining)
+        self.last = None
+        self.num_in_page = 0
+        if self.page_limit is None:
+            return self.query
+        return self.query.limit(self.page_limit)
+
+    def add(self, snapshot) -> dict:
+        """:return: The document to yield for snapshot"""
+        self.last = snapshot
+        self.num_in_page += 1
+        doc = snapshot.to_dict() or {}
+        if self.select != self.options.select:
+            doc = indexes.select_fields(doc, self.options.select)
+        return doc
+
 
 class DBFirestore(DB):
-    def __init__(self, collection_name, use_boxes):
-        super().__init__(collection_name, use_boxes)
+    def __init__(self, collection_name, use_boxes, cache: CachePolicy = None):
+        super().__init__(collection_name, use_boxes, cache)
         from firebase_admin import firestore
         blconfig.ensure_firebase_initialized()
         self.db = firestore.client()
@@ -98,11 +481,13 @@ class DBFirestore(DB):
         value = self._simplify_value(key, value)
         return value
 
-    def _where(self, *args):
-        query = self.collection.where(*args)
-        for item in query.stream():
-            ret = self._deserialize(item.to_dict() or {})
-            yield ret
+    def _where(self, field, op, value, options):
+        pager = FirestorePager(self.collection, field, op, value, options)
+        page_query = pager.next_page()
+        while page_query is not None:
+            for snapshot in page_query.stream():
+                yield pager.add(snapshot)
+            page_query = pager.next_page()
 
     @staticmethod
     def _simplify_value(key, value):
@@ -116,10 +501,54 @@ class DBFirestore(DB):
         value = self._expand_value(key, value)
         return self.collection.document(key).set(value)
 
+    def _stored_form(self, key, value):
+        return self._simplify_value(key, self._expand_value(key, value))
+
     def _delete(self, key) -> Any:
         ret = self.collection.document(key).delete()
         return ret
 
+    def watch(self, key) -> Watcher:
+        return FirestoreWatcher(self.collection.document(key))
+
+    def keys(self):
+        return [ref.id for ref in self.collection.list_documents()]
+
+    def _get_many(self, keys):
+        refs = [self.collection.document(k) for k in dict.fromkeys(keys)]
+        ret = {k: {} for k in keys}
+        for snapshot in self.db.get_all(refs):
+            value = snapshot.to_dict() or {}
+            ret[snapshot.id] = self._simplify_value(snapshot.id, value)
+        return ret
+
+    def _set_many(self, mapping):
+        def write(batch, key, value):
+            batch.set(self.collection.document(key),
+                      self._expand_value(key, value))
+        return self._write_in_batches(mapping.items(), write)
+
+    def _delete_many(self, keys):
+        def write(batch, key):
+            batch.delete(self.collection.document(key))
+        return self._write_in_batches(((k,) for k in keys), write)
+
+    def _write_in_batches(self, items, write_fn) -> list:
+        """Apply write_fn(batch, *item) over items, committing every
+        MAX_BATCH_SIZE writes"""
+        results = []
+        batch = self.db.batch()
+        num_in_batch = 0
+        for item in items:
+            write_fn(batch, *item)
+            num_in_batch += 1
+            if num_in_batch == MAX_BATCH_SIZE:
+                results += batch.commit()
+                batch = self.db.batch()
+                num_in_batch = 0
+        if num_in_batch:
+            results += batch.commit()
+        return results
 
     @staticmethod
     def _expand_value(key, value) -> Any:
@@ -133,6 +562,7 @@ class DBFirestore(DB):
         return ret
 
     def _compare_and_swap(self, key, expected_current_value, new_value) -> bool:
+        from google.cloud import firestore
         ref = self.collection.document(key)
         transaction = self.db.transaction()
 
@@ -147,7 +577,7 @@ class DBFirestore(DB):
             """
             snapshot = ref_.get(transaction=transaction_).to_dict() or {}
             snapshot = self._simplify_value(key, snapshot)
-            if snapshot == expected_current_value_:
+            if cas_matches(snapshot, expected_current_value_):
                 transaction_.set(ref_, self._expand_value(key, new_value_))
                 ret_ = True
             else:
@@ -158,9 +588,26 @@ class DBFirestore(DB):
                                     new_value)
         return ret
 
+    def _transact(self, key, fn):
+        from google.cloud import firestore
+        ref = self.collection.document(key)
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def run_in_transaction(transaction_):
+            snapshot = ref.get(transaction=transaction_).to_dict() or {}
+            current = self._simplify_value(key, snapshot)
+            new_value = fn(current)
+            if new_value is not UNCHANGED:
+                transaction_.set(ref, self._expand_value(key, new_value))
+            return current, new_value
+
+        return run_in_transaction(transaction)
+
     def delete_all_test_data(self):
         if self.collection_name.startswith('test_'):
-            delete_firestore_collection(self.collection)
+            delete_firestore_collection(self.collection, num_workers=4,
+                                        client=self.db)
             return True
         else:
             print('Not deleting collection %s whose name does not start with'
@@ -168,69 +615,461 @@ class DBFirestore(DB):
             return False
 
 
-def delete_firestore_collection(coll_ref, batch_size=10):
-    # WARNING: Only do this for test data!
-    # c.f. https://firebase.google.com/docs/firestore/solutions/delete-collections
-    docs = coll_ref.limit(batch_size).get()
-    deleted = 0
+def delete_firestore_collection(coll_ref, batch_size=MAX_BATCH_SIZE,
+                                num_workers=1,
+                                progress_fn: Callable[[Box], Any] = None,
+                                client=None) -> int:
+    """
+    WARNING: Only do this for test data!
+    c.f. https://firebase.google.com/docs/firestore/solutions/delete-collections
+
+    Streams document ids with key-only queries and deletes them in batched
+    writes, so the cost scales with the number of batches, not documents.
+
+    :param batch_size: Documents per page / write batch, max 500
+    :param num_workers: Batches to commit concurrently
+    :param progress_fn: Called with Box(deleted, batches, elapsed) after
+        each batch is committed
+    :param client: Firestore client the collection belongs to, defaults to
+        the default firebase app's
+    :return: Number of documents deleted
+    """
+    batch_size = min(batch_size, MAX_BATCH_SIZE)
+    if client is None:
+        from firebase_admin import firestore
+        blconfig.ensure_firebase_initialized()
+        client = firestore.client()
+    start = time.time()
+    progress = Box(deleted=0, batches=0, elapsed=0.)
+    progress_lock = threading.Lock()
+
+    def delete_batch(refs):
+        batch = client.batch()
+        for ref in refs:
+            batch.delete(ref)
+        batch.commit()
+        with progress_lock:
+            progress.deleted += len(refs)
+            progress.batches += 1
+            progress.elapsed = time.time() - start
+            if progress_fn is not None:
+                progress_fn(progress.copy())
+
+    def pages():
+        query = coll_ref.select([]).limit(batch_size)
+        while True:
+            docs = list(query.stream())
+            if not docs:
+                return
+            yield [doc.reference for doc in docs]
+            if len(docs) < batch_size:
+                return
+            query = coll_ref.select([]).limit(batch_size).start_after(docs[-1])
 
-    for doc in docs:
-        print(u'Deleting doc {} => {}'.format(doc.id, doc.to_dict()))
-        doc.reference.delete()
-        deleted = deleted + 1
-    if deleted >= batch_size:
-        return delete_firestore_collection(coll_ref, batch_size)
+    if num_workers <= 1:
+        for page in pages():
+            delete_batch(page)
+    else:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            in_flight = set()
+            for page in pages():
+                if len(in_flight) >= num_workers * 2:
+                    # Bound memory by waiting for some batches to finish
+                    done, in_flight = wait(in_flight,
+                                           return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                in_flight.add(executor.submit(delete_batch, page))
+            for future in in_flight:
+                future.result()
+    return progress.deleted
 
 
 LOCAL_COLLECTIONS = {}
+LOCAL_LOCK_STRIPES = {}
+LOCAL_INDEXES = {}
+LOCAL_INDEX_LOCKS = {}
+LOCAL_NOTIFIERS = {}
+LOCAL_COLLECTIONS_LOCK = threading.Lock()
+
+# Keys hash onto a fixed set of locks per collection so unrelated keys
+# rarely contend, without keeping a lock per key around.
+NUM_LOCK_STRIPES = 64
 
 
 class DBLocal(DB):
-    def __init__(self, collection_name, use_boxes):
-        super().__init__(collection_name, use_boxes)
-        self.collection = LOCAL_COLLECTIONS.setdefault(collection_name, {})
+    def __init__(self, collection_name, use_boxes, cache: CachePolicy = None):
+        super().__init__(collection_name, use_boxes, cache)
+        with LOCAL_COLLECTIONS_LOCK:
+            self.collection = LOCAL_COLLECTIONS.setdefault(collection_name, {})
+            self.lock_stripes = LOCAL_LOCK_STRIPES.setdefault(
+                collection_name,
+                [threading.Lock() for _ in range(NUM_LOCK_STRIPES)])
+            self.indexes = LOCAL_INDEXES.setdefault(collection_name, [])
+            self.index_lock = LOCAL_INDEX_LOCKS.setdefault(
+                collection_name, threading.Lock())
+            self.notifier = LOCAL_NOTIFIERS.setdefault(
+                collection_name, LocalChangeNotifier())
+
+    def watch(self, key) -> Watcher:
+        return LocalWatcher(self.notifier, key)
+
+    def keys(self):
+        return list(self.collection)
+
+    def add_index(self, field: str, kind: str = indexes.HASH):
+        """
+        Index field so where() doesn't scan the whole collection.
+        Indexes are shared by all DBLocal's on this collection.
+
+        :param field: Possibly dotted field path, i.e. 'a.b'
+        :param kind: indexes.HASH for ==, in and array-contains,
+            indexes.SORTED for ranges and ==
+        """
+        index = indexes.create_index(field, kind)
+        with self.index_lock:
+            for key, doc in list(self.collection.items()):
+                index.add(key, doc)
+            self.indexes.append(index)
+        return index
+
+    def _reindex(self, key, old_value, new_value):
+        if not self.indexes:
+            return
+        with self.index_lock:
+            for index in self.indexes:
+                if old_value is not indexes.MISSING:
+                    index.remove(key, old_value)
+                if new_value is not indexes.MISSING:
+                    index.add(key, new_value)
+
+    def _where(self, field, op, value, options):
+        with self.index_lock:
+            keys = indexes.find_keys(self.collection, self.indexes,
+                                     field, op, value)
+
+        def docs():
+            for key in keys:
+                doc = self.collection.get(key, indexes.MISSING)
+                # Documents can change after the index lookup, so recheck
+                if doc is not indexes.MISSING and \
+                        indexes.matches(doc, field, op, value):
+                    yield doc
+
+        return indexes.apply_options(docs(), options)
+
+    def _lock(self, key) -> threading.Lock:
+        return self.lock_stripes[hash(key) % NUM_LOCK_STRIPES]
+
+    @contextmanager
+    def _lock_many(self, keys):
+        # Acquire in a consistent order to avoid deadlocks
+        stripes = sorted({hash(k) % NUM_LOCK_STRIPES for k in keys})
+        with ExitStack() as stack:
+            for stripe in stripes:
+                stack.enter_context(self.lock_stripes[stripe])
+            yield
 
     def _get(self, key):
-        return self.collection.get(key, None)
+        with self._lock(key):
+            return self.collection.get(key, None)
 
     def _set(self, key, value):
+        with self._lock(key):
+            self._put(key, value)
+        self.notifier.changed(key)
+        return value
+
+    def _delete(self, key) -> Any:
+        with self._lock(key):
+            deleted = self._pop(key)
+        if deleted:
+            self.notifier.changed(key)
+        return time.time()
+
+    def _get_many(self, keys):
+        with self._lock_many(keys):
+            return {k: self.collection.get(k, None) for k in keys}
+
+    def _set_many(self, mapping):
+        with self._lock_many(mapping):
+            for key, value in mapping.items():
+                self._put(key, value)
+        for key in mapping:
+            self.notifier.changed(key)
+        return mapping
+
+    def _delete_many(self, keys):
+        with self._lock_many(keys):
+            deleted = [key for key in keys if self._pop(key)]
+        for key in deleted:
+            self.notifier.changed(key)
+        return time.time()
+
+    # _put and _pop need the key's lock, and callers notify watchers once
+    # they release it
+
+    def _put(self, key, value):
+        old_value = self.collection.get(key, indexes.MISSING)
         self.collection[key] = value
+        self._reindex(key, old_value, value)
+
+    def _pop(self, key) -> bool:
+        """
+        :return: Whether key existed. Like Firestore, deleting a missing key
+            does nothing.
+        """
+        old_value = self.collection.pop(key, indexes.MISSING)
+        if old_value is indexes.MISSING:
+            return False
+        self._reindex(key, old_value, indexes.MISSING)
+        return True
+
+    def _compare_and_swap(self, key, expected_current_value, new_value) -> bool:
+        with self._lock(key):
+            matches = cas_matches(self.collection.get(key, None),
+                                  expected_current_value)
+            if matches:
+                self._put(key, new_value)
+        if matches:
+            self.notifier.changed(key)
+        return matches
+
+    def _transact(self, key, fn):
+        with self._lock(key):
+            current = self.collection.get(key, None)
+            new_value = fn(current)
+            if new_value is not UNCHANGED:
+                self._put(key, new_value)
+        if new_value is not UNCHANGED:
+            self.notifier.changed(key)
+        return current, new_value
+
+    def delete_all_test_data(self):
+        with LOCAL_COLLECTIONS_LOCK:
+            keys = list(LOCAL_COLLECTIONS.keys())
+            for key in keys:
+                del LOCAL_COLLECTIONS[key]
+            LOCAL_INDEXES.clear()
+
+
+class DBSqlite(DB):
+    """
+    Persistent, multi-process stand-in for Firestore backed by a SQLite file
+    in WAL mode. Documents are stored as JSON the way Firestore stores them,
+    so get / where / CAS behave the same.
+    """
+    def __init__(self, collection_name, use_boxes, cache: CachePolicy = None,
+                 path: str = None):
+        super().__init__(collection_name, use_boxes, cache)
+        self.path = path or blconfig.sqlite_db_path
+        self._local = threading.local()
+        self._conn().execute(
+            'CREATE TABLE IF NOT EXISTS documents ('
+            ' collection TEXT NOT NULL,'
+            ' key TEXT NOT NULL,'
+            ' value TEXT NOT NULL,'
+            ' PRIMARY KEY (collection, key))')
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared across threads or forks
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        # Take the write lock up front so read-compare-write is atomic
+        # across processes
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+
+    def _read(self, conn, key):
+        row = conn.execute(
+            'SELECT value FROM documents WHERE collection = ? AND key = ?',
+            (self.collection_name, key)).fetchone()
+        value = sqlite_loads(row[0]) if row else {}
+        return DBFirestore._simplify_value(key, value)
+
+    def _write(self, conn, key, value):
+        value = DBFirestore._expand_value(key, value)
+        conn.execute(
+            'INSERT OR REPLACE INTO documents (collection, key, value) '
+            'VALUES (?, ?, ?)',
+            (self.collection_name, key, sqlite_dumps(value)))
+
+    def _remove(self, conn, key):
+        conn.execute(
+            'DELETE FROM documents WHERE collection = ? AND key = ?',
+            (self.collection_name, key))
+
+    def _get(self, key):
+        return self._read(self._conn(), key)
+
+    def keys(self):
+        rows = self._conn().execute(
+            'SELECT key FROM documents WHERE collection = ? ORDER BY key',
+            (self.collection_name,))
+        return [row[0] for row in rows]
+
+    def _set(self, key, value):
+        with self._transaction() as conn:
+            self._write(conn, key, value)
         return value
 
     def _delete(self, key) -> Any:
-        del self.collection[key]
+        with self._transaction() as conn:
+            self._remove(conn, key)
+        return time.time()
+
+    def _get_many(self, keys):
+        conn = self._conn()
+        conn.execute('BEGIN')
+        try:
+            return {k: self._read(conn, k) for k in keys}
+        finally:
+            conn.execute('COMMIT')
+
+    def _set_many(self, mapping):
+        with self._transaction() as conn:
+            for key, value in mapping.items():
+                self._write(conn, key, value)
+        return mapping
+
+    def _delete_many(self, keys):
+        with self._transaction() as conn:
+            for key in keys:
+                self._remove(conn, key)
         return time.time()
 
+    def _stored_form(self, key, value):
+        return DBFirestore._simplify_value(
+            key, DBFirestore._expand_value(key, value))
+
     def _compare_and_swap(self, key, expected_current_value, new_value) -> bool:
-        # Not threadsafe!
-        if self.collection[key] == expected_current_value:
-            self.collection[key] = new_value
+        with self._transaction() as conn:
+            if cas_matches(self._read(conn, key), expected_current_value):
+                self._write(conn, key, new_value)
+                return True
+            else:
+                return False
+
+    def _transact(self, key, fn):
+        with self._transaction() as conn:
+            current = self._read(conn, key)
+            new_value = fn(current)
+            if new_value is not UNCHANGED:
+                self._write(conn, key, new_value)
+        return current, new_value
+
+    def _where(self, field, op, value, options):
+        return indexes.apply_options(
+            self._where_docs(field, op, value), options)
+
+    def _where_docs(self, field, op, value):
+        if op not in indexes.SUPPORTED_OPS:
+            raise ValueError(f'Unsupported where operator {op}')
+        path = '$.' + field
+        # SQLite compares JSON values with its own type ordering, i.e.
+        # true = 1, so SQL only narrows down the rows and matches() has the
+        # final say like it does for DBLocal.
+        json_types = SQLITE_JSON_TYPES.get(type(value))
+        if op in ('==', '<', '<=', '>', '>=') and json_types and \
+                value is not None:
+            sql_op = '=' if op == '==' else op
+            type_list = ', '.join(f"'{t}'" for t in json_types)
+            condition = f'json_type(value, ?) IN ({type_list}) ' \
+                        f'AND json_extract(value, ?) {sql_op} ?'
+            params = [path, path, value]
+        elif op in indexes.ARRAY_CONTAINS_OPS:
+            condition = "json_type(value, ?) = 'array'"
+            params = [path]
+        else:
+            condition = 'json_type(value, ?) IS NOT NULL'
+            params = [path]
+        rows = self._conn().execute(
+            f'SELECT value FROM documents WHERE collection = ? '
+            f'AND {condition} ORDER BY key',
+            [self.collection_name] + params)
+        for row in rows:
+            doc = sqlite_loads(row[0])
+            if indexes.matches(doc, field, op, value):
+                yield doc
+
+    def delete_all_test_data(self):
+        if self.collection_name.startswith('test_'):
+            with self._transaction() as conn:
+                conn.execute('DELETE FROM documents WHERE collection = ?',
+                             (self.collection_name,))
             return True
         else:
+            print('Not deleting collection %s whose name does not start with'
+                  ' test_', file=sys.stderr)
             return False
 
-    def delete_all_test_data(self):
-        keys = list(LOCAL_COLLECTIONS.keys())
-        for key in keys:
-            del LOCAL_COLLECTIONS[key]
+
+def sqlite_dumps(value) -> str:
+    """JSON for DBSqlite, tagging bytes and datetimes"""
+    return json.dumps(value, default=_encode_sqlite_value)
+
+
+def sqlite_loads(text: str):
+    return json.loads(text, object_hook=_decode_sqlite_value)
+
+
+def _encode_sqlite_value(value):
+    if isinstance(value, bytes):
+        return {SQLITE_BYTES_TAG: base64.b64encode(value).decode()}
+    elif isinstance(value, datetime):
+        return {SQLITE_DATETIME_TAG: value.isoformat()}
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _decode_sqlite_value(obj: dict):
+    if len(obj) == 1:
+        if SQLITE_BYTES_TAG in obj:
+            return base64.b64decode(obj[SQLITE_BYTES_TAG])
+        elif SQLITE_DATETIME_TAG in obj:
+            return datetime.fromisoformat(obj[SQLITE_DATETIME_TAG])
+    return obj
 
 
 def get_db(collection_name: str = DEFAULT_COLLECTION,
            force_firestore_db=False,
-           use_boxes=True) -> DB:
+           use_boxes=True,
+           cache: CachePolicy = None) -> DB:
     """
 
     :param collection_name: Namespace for your db
     :param force_firestore_db: Use the remote Firestore db even in tests
     :param use_boxes: Return python-box objects instead of dicts / lists
+    :param cache: [Optional] Keep an LRU of read values, i.e.
+        CachePolicy(ttl=60, max_entries=100)
     :return:
     """
     test_name = get_test_name_from_callstack()
     if test_name and not force_firestore_db:
         print('We are in a test, %s, so not using Firestore' % test_name)
-        return DBLocal(collection_name, use_boxes)
+        return DBLocal(collection_name, use_boxes, cache)
     elif blconfig.should_use_firestore:
-        return DBFirestore(collection_name, use_boxes)
+        return DBFirestore(collection_name, use_boxes, cache)
+    elif blconfig.sqlite_db_path:
+        print('SHOULD_USE_FIRESTORE is false, so using SQLite db at %s' %
+              blconfig.sqlite_db_path)
+        return DBSqlite(collection_name, use_boxes, cache)
     else:
         print('SHOULD_USE_FIRESTORE is false, so not using Firestore')
-        return DBLocal(collection_name, use_boxes)
+        return DBLocal(collection_name, use_boxes, cache)
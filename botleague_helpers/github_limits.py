@@ -0,0 +1,224 @@
+"""
+Process wide scheduling of GitHub API calls, both PyGithub's and our own,
+to stay within the rate limit and avoid tripping secondary (abuse) limits.
+https://docs.github.com/en/rest/using-the-rest-api/best-practices-for-using-the-rest-api
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+import requests
+from box import Box
+from requests.structures import CaseInsensitiveDict
+
+from botleague_helpers.sessions import conditional_get, configure_endpoint, \
+    get_session, idempotent_retry, parse_retry_after
+
+GITHUB_API_URL = 'https://api.github.com'
+
+# GitHub asks that writes are serial and at least a second apart
+WRITE_INTERVAL = 1
+
+# Secondary limits also apply to concurrent requests
+MAX_CONCURRENT_REQUESTS = 10
+
+# Once remaining requests fall below this fraction of the limit, spread
+# the rest out until the limit resets
+PACE_FRACTION = 0.1
+
+# Requests to keep in reserve, i.e. for other processes sharing the token
+RESERVED_REQUESTS = 20
+
+READ_METHODS = ['GET', 'HEAD']
+
+configure_endpoint(GITHUB_API_URL, idempotent_retry(READ_METHODS))
+
+
+class GitHubScheduler:
+    """
+    Delays requests as needed based on the X-RateLimit-* and Retry-After
+    headers of earlier responses, queueing writes WRITE_INTERVAL apart.
+    """
+    def __init__(self, max_concurrent=MAX_CONCURRENT_REQUESTS,
+                 write_interval=WRITE_INTERVAL,
+                 reserved_requests=RESERVED_REQUESTS):
+        self.write_interval = write_interval
+        self.reserved_requests = reserved_requests
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.lock = threading.Lock()
+        self.remaining: Optional[int] = None
+        self.limit: Optional[int] = None
+        self.reset_at: Optional[float] = None
+        self.blocked_until = 0.
+        self.next_request_at = 0.
+        self.next_write_at = 0.
+        self.num_requests = 0
+        self.num_writes = 0
+        self.num_rate_limited = 0
+        self.throttled_seconds = 0.
+
+    @contextmanager
+    def request(self, write=False):
+        """Wait for our turn, then make one request within the block"""
+        with self.slots:
+            seconds = self._reserve(write)
+            if seconds > 0:
+                time.sleep(seconds)
+            yield
+
+    def observe(self, status_code: int, headers):
+        """Update our budget from a response's headers"""
+        headers = CaseInsensitiveDict(headers)
+        now = time.time()
+        with self.lock:
+            resource = headers.get('X-RateLimit-Resource', 'core')
+            if resource == 'core' and 'X-RateLimit-Remaining' in headers:
+                self.remaining = int(headers['X-RateLimit-Remaining'])
+                self.limit = int(headers.get('X-RateLimit-Limit') or 0) or \
+                    self.limit
+                if 'X-RateLimit-Reset' in headers:
+                    self.reset_at = float(headers['X-RateLimit-Reset'])
+            if status_code in [403, 429]:
+                retry_after = parse_retry_after(headers.get('Retry-After'))
+                if retry_after is not None:
+                    self.num_rate_limited += 1
+                    self.blocked_until = max(self.blocked_until,
+                                             now + retry_after)
+                elif self.remaining == 0 and self.reset_at:
+                    self.num_rate_limited += 1
+                    self.blocked_until = max(self.blocked_until,
+                                             self.reset_at)
+
+    @property
+    def stats(self) -> Box:
+        with self.lock:
+            reset_in = None
+            if self.reset_at is not None:
+                reset_in = max(0., self.reset_at - time.time())
+            return Box(remaining=self.remaining, limit=self.limit,
+                       reset_in=reset_in, requests=self.num_requests,
+                       writes=self.num_writes,
+                       rate_limited=self.num_rate_limited,
+                       throttled_seconds=self.throttled_seconds)
+
+    def _reserve(self, write: bool) -> float:
+        """:return: Seconds to wait before sending"""
+        with self.lock:
+            now = time.time()
+            start = max(now, self.blocked_until)
+            if self.remaining is not None and self.reset_at is not None and \
+                    self.reset_at > now:
+                spare = self.remaining - self.reserved_requests
+                if spare <= 0:
+                    start = max(start, self.reset_at)
+                elif self.limit and self.remaining < \
+                        self.limit * PACE_FRACTION:
+                    interval = (self.reset_at - now) / spare
+                    start = max(start, self.next_request_at)
+                    self.next_request_at = start + interval
+                # Other requests may be in flight before we hear back
+                self.remaining -= 1
+            if write:
+                start = max(start, self.next_write_at)
+                self.next_write_at = start + self.write_interval
+                self.num_writes += 1
+            self.num_requests += 1
+            self.throttled_seconds += start - now
+            return start - now
+
+
+scheduler = GitHubScheduler()
+
+
+def github_request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Make a scheduled request to the GitHub API with the shared session.
+    GETs are conditional, so unchanged resources don't use up our limit.
+    """
+    method = method.upper()
+    with scheduler.request(write=method not in READ_METHODS):
+        if method == 'GET':
+            resp = conditional_get(url, **kwargs)
+        else:
+            resp = get_session().request(method, url, **kwargs)
+    scheduler.observe(resp.status_code, resp.headers)
+    return resp
+
+
+_pygithub_hooks_installed = False
+_pygithub_hooks_lock = threading.Lock()
+
+
+def install_pygithub_hooks():
+    """
+    Send all PyGithub requests in this process through the scheduler and
+    shared session, with GETs made conditional like github_request's. This
+    relies on PyGithub 2.x internals, i.e. its
+    connection classes and Requester.injectConnectionClasses, hence the
+    pin in requirements.txt.
+    """
+    global _pygithub_hooks_installed
+    with _pygithub_hooks_lock:
+        if not _pygithub_hooks_installed:
+            _inject_pygithub_connections()
+            _pygithub_hooks_installed = True
+
+
+def uninstall_pygithub_hooks():
+    """Go back to PyGithub's own connections"""
+    global _pygithub_hooks_installed
+    from github.Requester import Requester
+    with _pygithub_hooks_lock:
+        Requester.resetConnectionClasses()
+        _pygithub_hooks_installed = False
+
+
+def _inject_pygithub_connections():
+    from github.Requester import HTTPRequestsConnectionClass, \
+        HTTPSRequestsConnectionClass, Requester, RequestsResponse
+
+    class ScheduledConnection:
+        # Mimics PyGithub's connection classes, minus their per connection
+        # requests.Session
+        def __init__(self, host: str, port: int = None, strict=False,
+                     timeout: int = None, retry=None, pool_size=None,
+                     **kwargs):
+            self.host = host
+            self.port = port or (443 if self.protocol == 'https' else 80)
+            self.timeout = timeout
+            self.verify = kwargs.get('verify', True)
+
+        request = HTTPSRequestsConnectionClass.request
+
+        def getresponse(self):
+            url = f'{self.protocol}://{self.host}:{self.port}{self.url}'
+            kwargs = dict(headers=self.headers, timeout=self.timeout,
+                          verify=self.verify, allow_redirects=False,
+                          auth=Requester.noopAuth)
+            # Blobs never change, and PyGithub may send its own ETag
+            conditional = self.verb == 'GET' and \
+                '/git/blobs/' not in self.url and \
+                'If-None-Match' not in self.headers
+            with scheduler.request(write=self.verb not in READ_METHODS):
+                if conditional:
+                    resp = conditional_get(url, **kwargs)
+                else:
+                    resp = get_session().request(self.verb, url,
+                                                 data=self.input, **kwargs)
+            scheduler.observe(resp.status_code, resp.headers)
+            return RequestsResponse(resp)
+
+        def close(self):
+            pass
+
+    class ScheduledHTTPConnection(ScheduledConnection,
+                                  HTTPRequestsConnectionClass):
+        protocol = 'http'
+
+    class ScheduledHTTPSConnection(ScheduledConnection,
+                                   HTTPSRequestsConnectionClass):
+        protocol = 'https'
+
+    Requester.injectConnectionClasses(ScheduledHTTPConnection,
+                                      ScheduledHTTPSConnection)
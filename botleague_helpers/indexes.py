@@ -0,0 +1,263 @@
+"""
+Firestore-style queries for the local DB's, and secondary indexes for the
+in-process DBLocal
+"""
+from bisect import bisect_left, insort
+from typing import Any, Generator, Iterable, Optional, Set
+
+from box import Box
+
+HASH = 'hash'
+SORTED = 'sorted'
+
+EQUALITY_OPS = ['==', 'in']
+RANGE_OPS = ['<', '<=', '>', '>=']
+ARRAY_CONTAINS_OPS = ['array_contains', 'array-contains']
+SUPPORTED_OPS = EQUALITY_OPS + RANGE_OPS + ARRAY_CONTAINS_OPS
+
+MISSING = object()
+
+
+def get_field(doc, field: str) -> Any:
+    """Get a possibly dotted field path, i.e. 'a.b', from a document"""
+    value = doc
+    for part in field.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+
+def type_rank(value) -> int:
+    """
+    Firestore orders values by type first, and comparisons only match values
+    of the same type.
+    https://firebase.google.com/docs/firestore/manage-data/data-types
+    """
+    if value is None:
+        return 0
+    elif isinstance(value, bool):
+        return 1
+    elif isinstance(value, (int, float)):
+        return 2
+    elif isinstance(value, str):
+        return 4
+    elif isinstance(value, bytes):
+        return 5
+    elif isinstance(value, list):
+        return 8
+    elif isinstance(value, dict):
+        return 9
+    else:
+        return 3  # i.e. datetime
+
+
+def sort_key(value):
+    return type_rank(value), value
+
+
+def equals(a, b) -> bool:
+    return type_rank(a) == type_rank(b) and a == b
+
+
+def matches(doc, field: str, op: str, value) -> bool:
+    field_value = get_field(doc, field)
+    if field_value is MISSING:
+        return False
+    if op == '==':
+        return equals(field_value, value)
+    elif op == 'in':
+        return any(equals(field_value, v) for v in value)
+    elif op in ARRAY_CONTAINS_OPS:
+        return isinstance(field_value, list) and \
+            any(equals(v, value) for v in field_value)
+    elif op in RANGE_OPS:
+        if type_rank(field_value) != type_rank(value):
+            return False
+        if op == '<':
+            return field_value < value
+        elif op == '<=':
+            return field_value <= value
+        elif op == '>':
+            return field_value > value
+        else:
+            return field_value >= value
+    else:
+        raise ValueError(f'Unsupported where operator {op}')
+
+
+def is_hashable(value) -> bool:
+    return not isinstance(value, (list, dict))
+
+
+class HashIndex:
+    """Answers == and in, plus array-contains on array fields"""
+    def __init__(self, field: str):
+        self.field = field
+        self.by_value = {}
+        self.by_element = {}
+
+    def add(self, key, doc):
+        value = get_field(doc, self.field)
+        if value is MISSING:
+            return
+        if is_hashable(value):
+            self.by_value.setdefault(sort_key(value), set()).add(key)
+        elif isinstance(value, list):
+            for element in value:
+                if is_hashable(element):
+                    self.by_element.setdefault(
+                        sort_key(element), set()).add(key)
+
+    def remove(self, key, doc):
+        value = get_field(doc, self.field)
+        if value is MISSING:
+            return
+        if is_hashable(value):
+            self._discard(self.by_value, value, key)
+        elif isinstance(value, list):
+            for element in value:
+                if is_hashable(element):
+                    self._discard(self.by_element, element, key)
+
+    @staticmethod
+    def _discard(table, value, key):
+        keys = table.get(sort_key(value))
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del table[sort_key(value)]
+
+    def lookup(self, op, value) -> Optional[Set[str]]:
+        """:return: Matching keys, or None if this index can't answer"""
+        if op == '==' and is_hashable(value):
+            return set(self.by_value.get(sort_key(value), ()))
+        elif op == 'in' and all(is_hashable(v) for v in value):
+            ret = set()
+            for v in value:
+                ret.update(self.by_value.get(sort_key(v), ()))
+            return ret
+        elif op in ARRAY_CONTAINS_OPS and is_hashable(value):
+            return set(self.by_element.get(sort_key(value), ()))
+        return None
+
+
+class SortedIndex:
+    """Answers range queries and == on scalar fields"""
+    def __init__(self, field: str):
+        self.field = field
+        self.entries = []  # Sorted (sort_key(value), key)
+
+    def add(self, key, doc):
+        value = get_field(doc, self.field)
+        if value is not MISSING and is_hashable(value):
+            insort(self.entries, (sort_key(value), key))
+
+    def remove(self, key, doc):
+        value = get_field(doc, self.field)
+        if value is not MISSING and is_hashable(value):
+            entry = (sort_key(value), key)
+            i = bisect_left(self.entries, entry)
+            if i < len(self.entries) and self.entries[i] == entry:
+                del self.entries[i]
+
+    def lookup(self, op, value) -> Optional[Set[str]]:
+        if op not in RANGE_OPS + ['=='] or not is_hashable(value):
+            return None
+        rank = type_rank(value)
+        target = sort_key(value)
+        # Range queries only match values of the same type
+        lo = bisect_left(self.entries, ((rank,),))
+        hi = bisect_left(self.entries, ((rank + 1,),))
+        if op == '==':
+            lo = bisect_left(self.entries, (target,), lo, hi)
+            hi = self._after(target, lo, hi)
+        elif op == '<':
+            hi = bisect_left(self.entries, (target,), lo, hi)
+        elif op == '<=':
+            hi = self._after(target, lo, hi)
+        elif op == '>':
+            lo = self._after(target, lo, hi)
+        elif op == '>=':
+            lo = bisect_left(self.entries, (target,), lo, hi)
+        return {key for _, key in self.entries[lo:hi]}
+
+    def _after(self, target, lo, hi) -> int:
+        """Index of the first entry whose value is greater than target"""
+        i = bisect_left(self.entries, (target,), lo, hi)
+        while i < hi and self.entries[i][0] == target:
+            i += 1
+        return i
+
+
+def create_index(field: str, kind: str = HASH):
+    if kind == HASH:
+        return HashIndex(field)
+    elif kind == SORTED:
+        return SortedIndex(field)
+    else:
+        raise ValueError(f'Unknown index kind {kind}, use {HASH} or {SORTED}')
+
+
+def find_keys(collection: dict, indexes: Iterable, field: str, op: str,
+              value) -> Iterable[str]:
+    """
+    :return: Keys of documents in collection matching the query, using an
+        index on field if one can answer it, else scanning.
+    """
+    if op not in SUPPORTED_OPS:
+        raise ValueError(f'Unsupported where operator {op}')
+    for index in indexes:
+        if index.field == field:
+            keys = index.lookup(op, value)
+            if keys is not None:
+                return sorted(keys)
+    # Copy items so concurrent writers can't resize the dict mid-scan
+    return sorted(k for k, doc in list(collection.items())
+                  if matches(doc, field, op, value))
+
+
+def apply_options(docs: Iterable[dict], options: Box) -> Generator:
+    """
+    Apply DB.where's order_by, start_after, limit and select options to
+    documents already ordered by key, streaming unless they need sorting.
+    """
+    if options.order_by:
+        field = options.order_by
+        # Like Firestore, ordering by a field excludes docs without it
+        docs = [d for d in docs if get_field(d, field) is not MISSING]
+        docs.sort(key=lambda d: sort_key(get_field(d, field)),
+                  reverse=options.descending)
+        if options.start_after:
+            cursor = sort_key(get_field(options.start_after, field))
+
+            def is_after(doc):
+                doc_key = sort_key(get_field(doc, field))
+                if options.descending:
+                    return doc_key < cursor
+                return doc_key > cursor
+            docs = [d for d in docs if is_after(d)]
+    elif options.start_after:
+        raise ValueError('start_after requires order_by')
+    num = 0
+    for doc in docs:
+        if options.limit is not None and num >= options.limit:
+            return
+        num += 1
+        if options.select:
+            doc = select_fields(doc, options.select)
+        yield doc
+
+
+def select_fields(doc: dict, fields: Iterable[str]) -> dict:
+    ret = {}
+    for field in fields:
+        value = get_field(doc, field)
+        if value is MISSING:
+            continue
+        parent = ret
+        parts = field.split('.')
+        for part in parts[:-1]:
+            parent = parent.setdefault(part, {})
+        parent[parts[-1]] = value
+    return ret
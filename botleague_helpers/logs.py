@@ -1,18 +1,24 @@
+import atexit
+import hashlib
+import json
 import os
-
+import queue
+import re
+import sys
+import threading
 import time
-from collections import defaultdict
-from copy import copy
+import traceback
+from collections import OrderedDict
+from typing import Any, Callable, List
 
+from box import Box
 
-from google.cloud import logging as gcloud_logging
+from botleague_helpers.cache import CachePolicy, LRUCache
 from botleague_helpers.config import in_test, blconfig
 from botleague_helpers.crypto import decrypt_db_key
 from botleague_helpers import utils
 from botleague_helpers import upload
 
-import slack
-
 """
 Usage:
 # Encrypt SLACK_ERROR_BOT_TOKEN to your secrets DB
@@ -60,97 +66,425 @@ VALID_STACK_DRIVER_LEVELS = ['DEFAULT', 'DEBUG', 'INFO', 'NOTICE', 'WARNING',
                              'ERROR', 'CRITICAL', 'ALERT', 'EMERGENCY']
 stackdriver_client = None
 
-def add_stackdriver_sink(loguru_logger, log_name):
+# What to do with a record when the Stackdriver queue is full
+DROP = 'drop'
+BLOCK = 'block'
+
+STACKDRIVER_QUEUE_SIZE = 10000
+STACKDRIVER_BATCH_SIZE = 500
+STACKDRIVER_FLUSH_SECONDS = 2
+
+
+def add_stackdriver_sink(loguru_logger, log_name,
+                         max_queue_size=STACKDRIVER_QUEUE_SIZE,
+                         batch_size=STACKDRIVER_BATCH_SIZE,
+                         flush_seconds=STACKDRIVER_FLUSH_SECONDS,
+                         when_full=DROP):
     """Google cloud log sink in "Global" i.e.
     https://console.cloud.google.com/logs/viewer?project=silken-impulse-217423&minLogLevel=0&expandAll=false&resource=global
+
+    Records are queued and sent in batches from a background thread, so
+    logging never waits on a network round trip unless when_full is BLOCK
+    and the queue is full.
+
+    :param when_full: DROP or BLOCK when max_queue_size records are waiting
+    :return: The StackdriverWorker whose stats hold the queue depth and
+        drop counts, or None if we're not sending logs to Stackdriver
     """
     global stackdriver_client
-    if not in_test() and stackdriver_client is None and \
-            not blconfig.disable_cloud_log_sinks:
+    if in_test() or blconfig.disable_cloud_log_sinks:
+        return None
+    if stackdriver_client is None:
+        from google.cloud import logging as gcloud_logging
         stackdriver_client = gcloud_logging.Client()
-        stackdriver_logger = stackdriver_client.logger(log_name)
+    worker = StackdriverWorker(stackdriver_client.logger(log_name),
+                               max_queue_size=max_queue_size,
+                               batch_size=batch_size,
+                               flush_seconds=flush_seconds,
+                               when_full=when_full)
 
     def sink(message):
-        record = message.record
-        level = str(record['level'])
-        if level == 'SUCCESS':
-            severity = 'NOTICE'
-        elif level == 'TRACE':
-            # Nothing lower than DEBUG in stackdriver
-            severity = 'DEBUG'
-        elif level == 'EXCEPTION':
-            severity = 'ERROR'
-        elif level in VALID_STACK_DRIVER_LEVELS:
-            severity = level
-        else:
-            severity = 'INFO'
         if not in_test():
-            stackdriver_logger.log_text(message, severity=severity)
+            worker.put(get_stackdriver_entry(message.record))
 
     loguru_logger.add(sink)
+    return worker
+
+
+def get_stackdriver_severity(level: str) -> str:
+    if level == 'SUCCESS':
+        severity = 'NOTICE'
+    elif level == 'TRACE':
+        # Nothing lower than DEBUG in stackdriver
+        severity = 'DEBUG'
+    elif level == 'EXCEPTION':
+        severity = 'ERROR'
+    elif level in VALID_STACK_DRIVER_LEVELS:
+        severity = level
+    else:
+        severity = 'INFO'
+    return severity
+
+
+def get_stackdriver_entry(record: dict) -> Box:
+    """Structured log entry with the loguru record's fields"""
+    info = dict(
+        message=record['message'],
+        level=record['level'].name,
+        name=record['name'],
+        module=record['module'],
+        function=record['function'],
+        file=record['file'].path,
+        line=record['line'],
+        process=record['process'].id,
+        thread=record['thread'].name,
+    )
+    if record['exception'] is not None:
+        info['exception'] = ''.join(
+            traceback.format_exception(*record['exception']))
+    if record['extra']:
+        # Stackdriver needs JSON
+        info['extra'] = json.loads(json.dumps(record['extra'], default=str))
+    return Box(info=info,
+               severity=get_stackdriver_severity(record['level'].name),
+               timestamp=record['time'])
+
+
+class QueueWorker:
+    """
+    Handles queued items on a background thread, so callers never wait on
+    the network, and flushes what's left at exit. Subclasses set up their
+    own state, then call this __init__, which starts _run.
+    """
+    def __init__(self, max_queue_size: int, when_full: str = DROP):
+        if when_full not in (DROP, BLOCK):
+            raise ValueError(f'when_full must be {DROP} or {BLOCK}')
+        self.when_full = when_full
+        self.num_dropped = 0
+        self.num_failed = 0
+        self.queue = queue.Queue(max_queue_size)
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, item: Box):
+        if self.when_full == BLOCK:
+            self.queue.put(item)
+        else:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.num_dropped += 1
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Wait for items queued so far to be handled
+        :return: False if we timed out
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        flushed = threading.Event()
+        try:
+            # Wait for room rather than dropping the flush request
+            self.queue.put(flushed, timeout=timeout)
+        except queue.Full:
+            return False
+        if deadline is not None:
+            timeout = max(0., deadline - time.time())
+        return flushed.wait(timeout)
+
+    def close(self, timeout: float = 10) -> bool:
+        """
+        Flush, waiting at most timeout seconds, i.e. so exiting can't hang
+        behind a slow network call
+        :return: False if we timed out
+        """
+        if self.closed:
+            return True
+        self.closed = True
+        return self.flush(timeout)
+
+    def _run(self):
+        """Handle items until the process exits, setting flush Events"""
+        raise NotImplementedError()
+
+
+class StackdriverWorker(QueueWorker):
+    """
+    Sends queued log entries to Stackdriver in batches of up to batch_size,
+    at least every flush_seconds, and flushes what's left at exit.
+    """
+    def __init__(self, stackdriver_logger, max_queue_size: int,
+                 batch_size: int, flush_seconds: float, when_full: str):
+        self.stackdriver_logger = stackdriver_logger
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.num_sent = 0
+        super().__init__(max_queue_size, when_full)
+
+    @property
+    def stats(self) -> Box:
+        return Box(queue_depth=self.queue.qsize(), sent=self.num_sent,
+                   dropped=self.num_dropped, failed=self.num_failed)
+
+    def _run(self):
+        while True:
+            entries = []
+            flushed = None
+            deadline = None
+            while len(entries) < self.batch_size:
+                if deadline is None:
+                    # Wait as long as it takes for the first entry
+                    item = self.queue.get()
+                    deadline = time.time() + self.flush_seconds
+                else:
+                    try:
+                        item = self.queue.get(
+                            timeout=max(0, deadline - time.time()))
+                    except queue.Empty:
+                        break
+                if isinstance(item, threading.Event):
+                    flushed = item
+                    break
+                entries.append(item)
+            self._write(entries)
+            if flushed is not None:
+                flushed.set()
+
+    def _write(self, entries: List[Box]):
+        if not entries:
+            return
+        try:
+            batch = self.stackdriver_logger.batch()
+            for entry in entries:
+                batch.log_struct(entry.info.to_dict(), severity=entry.severity,
+                                 timestamp=entry.timestamp)
+            batch.commit()
+            self.num_sent += len(entries)
+        except Exception as e:
+            # Logging this would just queue another entry that could fail
+            self.num_failed += len(entries)
+            print(f'Failed to send {len(entries)} log entries to '
+                  f'Stackdriver: {e}', file=sys.stderr)
+
+
+SLACK_ALERT_LEVELS = ['ERROR', 'CRITICAL', 'ALERT', 'EMERGENCY']
 
+# Notify about the same error at most this often
+SLACK_RENOTIFY_SECONDS = 60 * 5
 
-class SlackMsgHash:
-    last_notified: float = None
-    count: int = 0
+# Slack allows about one message per second per channel
+SLACK_MESSAGES_PER_SECOND = 1
+SLACK_BURST = 5
 
-def add_slack_error_sink(loguru_logger, channel: str, log_name: str = ''):
+SLACK_QUEUE_SIZE = 1000
+SLACK_MAX_FINGERPRINTS = 1000
+SLACK_FINGERPRINT_TTL = 60 * 60
+SLACK_MAX_DIGEST_ERRORS = 20
+SLACK_MAX_MESSAGE_CHARS = 1000
+
+UUID_RE = re.compile(r'\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                     r'[0-9a-f]{12}\b', re.IGNORECASE)
+HEX_ID_RE = re.compile(r'\b(0x[0-9a-f]+|[0-9a-f]{8,})\b', re.IGNORECASE)
+NUMBER_RE = re.compile(r'\d+')
+
+
+def add_slack_error_sink(loguru_logger, channel: str, log_name: str = '',
+                         messages_per_second=SLACK_MESSAGES_PER_SECOND,
+                         burst=SLACK_BURST,
+                         renotify_seconds=SLACK_RENOTIFY_SECONDS):
+    """
+    Post errors to a Slack channel from a background thread, at most once
+    per renotify_seconds for each kind of error, and rolling errors over
+    the rate limit into digests.
+
+    :return: The SlackWorker, or None if we're not sending to Slack
+    """
     if 'TEST_ALERTS' not in os.environ and (in_test() or
                                             blconfig.disable_cloud_log_sinks):
         loguru_logger.info('Not adding slack notifier')
-        return
+        return None
 
+    import slack
     client = slack.WebClient(token=decrypt_db_key('SLACK_ERROR_BOT_TOKEN'))
 
-    msg_hashes = defaultdict(SlackMsgHash)
+    def post(text):
+        client.chat_postMessage(channel=channel, text=text)
+
+    worker = SlackWorker(post, log_name=log_name,
+                         messages_per_second=messages_per_second,
+                         burst=burst, renotify_seconds=renotify_seconds)
 
     def sink(message):
-        import hashlib
-        level = str(message.record['level'])
-
-        def send_message():
-            # Basic data types in closure are immutable
-            msg_copy = copy(message)
-            if len(msg_copy) > 1000:
-                msg_copy = upload_to_gcs(msg_copy)
-            else:
-                msg_copy = f'```{msg_copy}```'
-            message_plus_count = f'{msg_copy}\n' \
-                f'Message duplicates in this process ' \
-                f'{msg_hashes[msg_hash].count}'
-            if log_name:
-                message_plus_count = f'*{log_name}*\n{message_plus_count}'
-            response = client.chat_postMessage(channel=channel,
-                                               text=message_plus_count,)
-            msg_hashes[msg_hash].last_notified = time.time()
-            # assert response["ok"]
-            # assert response["message"]["text"] == message
-
-        def upload_to_gcs(msg_copy):
-            log_time = message.record['time'].isoformat().replace(':', '')
-            rando = utils.generate_rand_alphanumeric(10)
-            log_url = upload.upload_str(
-                name=f'{log_time}_{rando}.txt',
-                content=msg_copy,
-                bucket_name='deepdrive-alert-logs')
-            # Truncate message for slack
-            msg_copy = f'```{msg_copy[:500]}\n...\n{msg_copy[-500:]}```' \
-                f'\nFull message: {log_url}'
-            return msg_copy
-
-        if level in ['ERROR', 'CRITICAL', 'ALERT', 'EMERGENCY']:
-            text = message.record['message']
-            msg_hash = hashlib.md5(text.encode()).hexdigest()
-            if msg_hash in msg_hashes:
-                last_notified = msg_hashes[msg_hash].last_notified
-                if time.time() - last_notified > 60 * 5:
-                    send_message()
-            else:
-                send_message()
-
-            msg_hashes[msg_hash].count += 1
+        record = message.record
+        if record['level'].name in SLACK_ALERT_LEVELS:
+            worker.put(Box(text=str(message),
+                           summary=record['message'].split('\n')[0][:200],
+                           fingerprint=get_error_fingerprint(record),
+                           time=record['time']))
 
     loguru_logger.add(sink)
+    return worker
+
+
+def normalize_error_message(message: str) -> str:
+    """Mask numbers and ids so near identical errors look the same"""
+    message = UUID_RE.sub('<id>', message)
+    message = HEX_ID_RE.sub('<id>', message)
+    return NUMBER_RE.sub('<n>', message)
+
+
+def get_error_fingerprint(record: dict) -> str:
+    location = f"{record['name']}:{record['function']}:{record['line']}"
+    message = normalize_error_message(record['message'])
+    return hashlib.md5(f'{location}\n{message}'.encode()).hexdigest()
+
+
+class SlackWorker(QueueWorker):
+    """
+    Posts queued errors to Slack, deduped by fingerprint and rate limited
+    with a token bucket. Repeats within renotify_seconds are counted and
+    reported with the next notification for that error. Errors over the
+    rate limit are summarized in one digest once a token is available, or
+    when flushing.
+    """
+    def __init__(self, post_fn: Callable[[str], Any], log_name: str = '',
+                 messages_per_second=SLACK_MESSAGES_PER_SECOND,
+                 burst=SLACK_BURST,
+                 renotify_seconds=SLACK_RENOTIFY_SECONDS,
+                 max_queue_size=SLACK_QUEUE_SIZE,
+                 max_fingerprints=SLACK_MAX_FINGERPRINTS):
+        self.post_fn = post_fn
+        self.log_name = log_name
+        self.renotify_seconds = renotify_seconds
+        self.bucket = utils.TokenBucket(messages_per_second, burst)
+        # fingerprint => Box(last_notified, suppressed)
+        self.fingerprints = LRUCache(CachePolicy(
+            ttl=SLACK_FINGERPRINT_TTL, max_entries=max_fingerprints))
+        # fingerprint => Box(summary, count), waiting for the rate limit
+        self.digest = OrderedDict()
+        self.num_digest_overflow = 0
+        self.num_sent = 0
+        self.num_deduped = 0
+        super().__init__(max_queue_size)
+
+    @property
+    def stats(self) -> Box:
+        return Box(queue_depth=self.queue.qsize(), sent=self.num_sent,
+                   deduped=self.num_deduped, dropped=self.num_dropped,
+                   failed=self.num_failed, fingerprints=len(self.fingerprints),
+                   digest_errors=len(self.digest))
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self.digest:
+                timeout = self.bucket.seconds_until_available()
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if isinstance(item, threading.Event):
+                self._send_digest()
+                item.set()
+                continue
+            if item is not None:
+                try:
+                    self._handle(item)
+                except Exception as e:
+                    # Keep going so one bad entry can't stop notifications
+                    self.num_failed += 1
+                    print(f'Failed to handle Slack error: {e}',
+                          file=sys.stderr)
+            if self.digest and self.bucket.try_acquire():
+                self._send_digest()
+
+    def _handle(self, entry: Box):
+        now = time.time()
+        found, state = self.fingerprints.get(entry.fingerprint)
+        if found and now - state.last_notified < self.renotify_seconds:
+            state.suppressed += 1
+            self.fingerprints.put(entry.fingerprint, state)
+            self.num_deduped += 1
+            return
+        suppressed = state.suppressed if found else 0
+        if entry.fingerprint in self.digest or not self.bucket.try_acquire():
+            self._add_to_digest(entry, count=1 + suppressed)
+            return
+        text = self._format(entry)
+        if suppressed:
+            text += f'\n{suppressed} more occurrences since the last ' \
+                f'notification'
+        self._post(text)
+        self.fingerprints.put(entry.fingerprint,
+                              Box(last_notified=now, suppressed=0))
+
+    def _add_to_digest(self, entry: Box, count: int):
+        if entry.fingerprint in self.digest:
+            self.digest[entry.fingerprint].count += count
+        elif len(self.digest) < SLACK_MAX_DIGEST_ERRORS:
+            self.digest[entry.fingerprint] = Box(summary=entry.summary,
+                                                 count=count)
+        else:
+            self.num_digest_overflow += count
+
+    def _send_digest(self):
+        if not self.digest:
+            return
+        total = sum(e.count for e in self.digest.values()) + \
+            self.num_digest_overflow
+        lines = [f'{e.count}x {e.summary}' for e in self.digest.values()]
+        if self.num_digest_overflow:
+            lines.append(f'{self.num_digest_overflow}x other errors')
+        lines = '\n'.join(lines)
+        self._post(f'{total} more error occurrences while rate limited:\n'
+                   f'```{lines}```')
+        now = time.time()
+        for fingerprint in self.digest:
+            self.fingerprints.put(fingerprint,
+                                  Box(last_notified=now, suppressed=0))
+        self.digest.clear()
+        self.num_digest_overflow = 0
+
+    def _format(self, entry: Box) -> str:
+        if len(entry.text) <= SLACK_MAX_MESSAGE_CHARS:
+            return f'```{entry.text}```'
+        try:
+            return upload_long_message(entry.text, entry.time)
+        except Exception as e:
+            self.num_failed += 1
+            print(f'Failed to upload long Slack message: {e}',
+                  file=sys.stderr)
+            return truncate_message(entry.text)
+
+    def _post(self, text: str):
+        if self.log_name:
+            text = f'*{self.log_name}*\n{text}'
+        try:
+            self.post_fn(text)
+            self.num_sent += 1
+        except Exception as e:
+            # Logging this error would just queue another message
+            self.num_failed += 1
+            print(f'Failed to post to Slack: {e}', file=sys.stderr)
+
+
+def upload_long_message(text: str, log_time) -> str:
+    """
+    Upload text to GCS and return a truncated version linking to it
+    """
+    log_time = log_time.isoformat().replace(':', '')
+    rando = utils.generate_rand_alphanumeric(10)
+    log_url = upload.upload_str(
+        name=f'{log_time}_{rando}.txt',
+        content=text,
+        bucket_name='deepdrive-alert-logs')
+    return f'{truncate_message(text)}\nFull message: {log_url}'
+
+
+def truncate_message(text: str) -> str:
+    """Keep the start and end of text, which fit in a Slack message"""
+    return f'```{text[:500]}\n...\n{text[-500:]}```'
 
 
 def sanity(x):
@@ -1,44 +1,245 @@
 from box import Box
 from typing import List, Union
+import asyncio
+import inspect
+import random
+import threading
 import time
+import uuid
+import zlib
 
 from loguru import logger as log
 
-from botleague_helpers.db import get_db
+from botleague_helpers.async_db import AsyncDB, get_async_db
+from botleague_helpers.db import UNCHANGED, get_db
 
 WAITING = 'waiting'
 REVIEWING = 'reviewing'
 FINISHED = 'finished'
 
+# Seconds to wait between attempts to become reviewer when the db can't
+# notify us of changes, or we miss a notification
+MIN_WAIT = 0.1
+MAX_WAIT = 5
 
-def create_reduce(reduce_id, db=None):
+# Seconds a reviewer holds the reduce before waiters may take it over.
+# Live reviewers renew the lease while reducing, so this only bounds how
+# long a crashed reviewer blocks everyone else.
+DEFAULT_LEASE_SECONDS = 60
+
+# Completed items are spread over at least this many docs so concurrent
+# mappers rarely contend on the same one
+DEFAULT_NUM_SHARDS = 10
+
+# More shards are used for big reduces, so the item ids each shard keeps
+# to dedupe marks stay well under Firestore's 1 MiB document limit
+MAX_ITEMS_PER_SHARD = 5000
+
+
+def create_reduce(reduce_id, db=None, expected_count: int = None,
+                  num_shards: int = DEFAULT_NUM_SHARDS):
     """
     Setup reduce (see below). This should be done before
     fanning out / mapping.
+
+    :param expected_count: [Optional] Number of items being mapped. Mappers
+    then call mark_item_done() instead of providing their own ready_fn.
+    :param num_shards: Min number of docs to spread completed items over
     """
     db = db or get_reduce_db()
+    if expected_count is not None:
+        num_shards = max(num_shards, -(-expected_count // MAX_ITEMS_PER_SHARD))
+        docs = {get_shard_key(reduce_id, i): Box(reduce_id=reduce_id, count=0,
+                                                 items=[])
+                for i in range(num_shards)}
+        docs[get_fan_in_key(reduce_id)] = Box(expected_count=expected_count,
+                                              num_shards=num_shards)
+        db.set_many(docs)
     db.set(reduce_id, WAITING)
 
 
+def mark_item_done(reduce_id: str, item_id: str, reduce_fn: callable,
+                   db=None, **try_reduce_kwargs) -> Union[bool, Box]:
+    """
+    Record that a mapped item is complete, and reduce if it was the last one.
+    Marking an item more than once counts it once. Needs the reduce to be
+    created with an expected_count.
+
+    Costs one shard transaction and a read of each shard's count per item.
+
+    :return: Result of reduce_fn if we reduced, else False
+    """
+    db = db or get_reduce_db()
+    fan_in = db.get(get_fan_in_key(reduce_id))
+    if not fan_in:
+        raise RuntimeError(f'Reduce {reduce_id} was not created with an '
+                           f'expected_count')
+    num_shards = fan_in['num_shards']
+    shard = zlib.crc32(item_id.encode()) % num_shards
+
+    def add_item(shard_doc):
+        if item_id in shard_doc['items']:
+            return UNCHANGED
+        shard_doc['items'].append(item_id)
+        shard_doc['count'] += 1
+        return shard_doc
+
+    db.transact(get_shard_key(reduce_id, shard), add_item)
+
+    def ready_fn():
+        return count_items_done(reduce_id, db) >= fan_in['expected_count']
+
+    if not ready_fn():
+        # Only mappers that see the last item done need to try
+        return False
+    return try_reduce_async(reduce_id, ready_fn, reduce_fn, db,
+                            **try_reduce_kwargs)
+
+
+def count_items_done(reduce_id: str, db=None) -> int:
+    """Sum the shards' counts without fetching their item ids"""
+    db = db or get_reduce_db()
+    shards = db.where('reduce_id', '==', reduce_id, select=['count'])
+    return sum(s['count'] for s in shards)
+
+
+def get_fan_in_key(reduce_id: str) -> str:
+    return f'{reduce_id}_fan_in'
+
+
+def get_shard_key(reduce_id: str, shard: int) -> str:
+    return f'{reduce_id}_items_done_{shard}'
+
+
+def get_status(state) -> str:
+    """Reviewing states are leases, the rest are plain status strings"""
+    if isinstance(state, dict):
+        return state.get('status')
+    return state
+
+
+def get_token(state) -> int:
+    if isinstance(state, dict):
+        return state.get('token', 0)
+    return 0
+
+
+def lease_expired(state) -> bool:
+    # Plain REVIEWING strings are from before leases and never expire
+    return get_status(state) == REVIEWING and isinstance(state, dict) and \
+        state.get('lease_expires', 0) < time.time()
+
+
+def new_lease(owner: str, token: int, lease_seconds: float) -> Box:
+    """
+    :param token: Fencing token, incremented on every takeover so a
+        reviewer whose lease expired can't clobber its successor
+    """
+    return Box(status=REVIEWING, owner=owner, token=token,
+               lease_expires=time.time() + lease_seconds)
+
+
+def claim_lease(reduce_id, state, owner: str, lease_seconds: float):
+    """
+    :return: A new lease for owner if the reduce is waiting or its
+        reviewer's lease expired, else UNCHANGED
+    """
+    if get_status(state) == WAITING or lease_expired(state):
+        if lease_expired(state):
+            log.warning(f'Taking over expired reviewer lease on '
+                        f'{reduce_id} from {state.get("owner")}')
+        return new_lease(owner, get_token(state) + 1, lease_seconds)
+    return UNCHANGED
+
+
+def holds_lease(state, lease: Box) -> bool:
+    return get_status(state) == REVIEWING and \
+        get_token(state) == lease.token
+
+
+class LeaseRenewer:
+    """Renews our reviewer lease in the background while we reduce"""
+    def __init__(self, db, reduce_id, lease: Box, lease_seconds: float):
+        self.db = db
+        self.reduce_id = reduce_id
+        self.lease = lease
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def holds_lease(self, state) -> bool:
+        return holds_lease(state, self.lease)
+
+    def _run(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            renewed = new_lease(self.lease.owner, self.lease.token,
+                                self.lease_seconds)
+            if not self.db.update_if(self.reduce_id, self.holds_lease,
+                                     renewed):
+                log.error(f'Lost reviewer lease on {self.reduce_id}')
+                self.lost = True
+                return
+
+
 def try_reduce_async(reduce_id: str, ready_fn: callable, reduce_fn: callable,
-                     db=None, max_attempts=-1) -> Union[bool, Box]:
+                     db=None, max_attempts=-1, wait_for_changes=True,
+                     metrics: Box = None,
+                     lease_seconds: float = DEFAULT_LEASE_SECONDS) \
+        -> Union[bool, Box]:
     """
     Concurrent-safe execution of reduce_fn when ready_fn is True.
 
     :param reduce_id: Unique string representing your reduce operation
     :param ready_fn: Function that returns True when reduce items are ready
-    :param reduce_fn: Function that executes reduce, i.e. reduce
+    :param reduce_fn: Function that executes reduce, i.e. reduce. If it takes
+    a token keyword, it's passed our lease's fencing token, which increases
+    on every takeover, so it can reject writes from a stale reviewer.
     :param db: [Optional] DB to use (i.e. for testing)
     :param max_attempts [Optional] For testing - number of times to sleep
     while waiting for result. -1 means to wait until current reviewer is done,
     which is always what you want outside of tests.
-    :return: Returns Box(reduce_result=reduce_fn()), else False
+    :param wait_for_changes: Wake up as soon as the current reviewer is done
+    by watching the reduce document, backing off exponentially between
+    attempts otherwise. False polls every MIN_WAIT seconds.
+    :param metrics: [Optional] Box to fill with cas_attempts, waits and
+    wait_seconds for this call
+    :param lease_seconds: How long other callers wait on us before assuming
+    we crashed and taking over. Renewed while reduce_fn runs.
+    :return: Result of reduce_fn, else False, including when our lease was
+    taken over before we could mark the reduce finished
     """
+    metrics = Box() if metrics is None else metrics
+    metrics.cas_attempts = 0
+    metrics.waits = 0
+    metrics.wait_seconds = 0.
+
+    owner = uuid.uuid4().hex
+    claim = Box(previous=None, lease=None)
+
+    def take_lease(state):
+        new_state = claim_lease(reduce_id, state, owner, lease_seconds)
+        claim.lease = None if new_state is UNCHANGED else new_state
+        return new_state
 
     def become_reviewer():
-        waiting = db.compare_and_swap(reduce_id, WAITING, REVIEWING)
-        finished = db.compare_and_swap(reduce_id, FINISHED, FINISHED)
-        return waiting or finished
+        """
+        One transaction that claims the reduce if it's waiting or the
+        reviewer's lease expired.
+        Done waiting if we claimed it or it's already finished.
+        """
+        metrics.cas_attempts += 1
+        claim.previous = db.transact(reduce_id, take_lease)
+        return claim.lease is not None or \
+            get_status(claim.previous) == FINISHED
 
     # If not complete, become reviewer and mark complete or not
     db = db or get_reduce_db()
@@ -52,33 +253,172 @@ def try_reduce_async(reduce_id: str, ready_fn: callable, reduce_fn: callable,
         # For testing only
         return max_attempts == -1 or attempts < max_attempts
 
-    # CAS that we are reviewing to prevent other reviewers
-    while not become_reviewer():
-        # Note: max attempts is just for testing.
+    watcher = None
+    wait_time = MIN_WAIT
+    try:
+        # CAS that we are reviewing to prevent other reviewers
+        while not become_reviewer():
+            # Note: max attempts is just for testing.
+
+            # If CAS fails, wait for other reviewer finish
+            wait_start = time.time()
+            if not wait_for_changes:
+                time.sleep(MIN_WAIT)
+            else:
+                # Only watch once we know we have to wait
+                watcher = watcher or db.watch(reduce_id)
+                # Full jitter so waiters that miss a change spread out
+                watcher.wait(random.uniform(MIN_WAIT, wait_time))
+                wait_time = min(wait_time * 2, MAX_WAIT)
+            metrics.waits += 1
+            metrics.wait_seconds += time.time() - wait_start
+            attempts += 1
+            if not should_wait():
+                log.warning('Not waiting to become reviewer')
+                return False
+    finally:
+        if watcher is not None:
+            watcher.close()
+        log.debug(f'Reduce {reduce_id} took {metrics.cas_attempts} '
+                  f'CAS attempts')
+
+    # Previous reviewers may have finished already, in which case we did
+    # not become reviewer.
+    if claim.lease is None:
+        return False
+    else:
+        # We are the reviewer, reduce if we are ready
+        renewer = LeaseRenewer(db, reduce_id, claim.lease, lease_seconds)
+        try:
+            with renewer:
+                if ready_fn():
+                    ret = call_reduce_fn(reduce_fn, claim.lease.token)
+                    next_state = FINISHED
+                else:
+                    # Not ready, don't reduce
+                    ret = False
+                    next_state = Box(status=WAITING, token=claim.lease.token)
+        except BaseException:
+            # Let waiters retry now rather than once our lease expires
+            db.update_if(reduce_id, renewer.holds_lease,
+                         Box(status=WAITING, token=claim.lease.token))
+            raise
+        if renewer.lost or \
+                not db.update_if(reduce_id, renewer.holds_lease, next_state):
+            log.error(f'Reviewer lease on {reduce_id} expired and was taken '
+                      f'over before we set it to {get_status(next_state)}')
+            return False
+        return ret
+
+
+async def try_reduce(reduce_id: str, ready_fn: callable, reduce_fn: callable,
+                     db: AsyncDB = None, max_attempts=-1,
+                     metrics: Box = None,
+                     lease_seconds: float = DEFAULT_LEASE_SECONDS) \
+        -> Union[bool, Box]:
+    """
+    asyncio version of try_reduce_async, see it for params. ready_fn and
+    reduce_fn may be regular or async functions.
+    """
+    metrics = Box() if metrics is None else metrics
+    metrics.cas_attempts = 0
+    metrics.waits = 0
+    metrics.wait_seconds = 0.
+    db = db or get_async_reduce_db()
+
+    if not await db.get(reduce_id):
+        raise RuntimeError(f'Reduce collection {reduce_id} does not exist')
+
+    owner = uuid.uuid4().hex
+    claim = Box(previous=None, lease=None)
+
+    def take_lease(state):
+        new_state = claim_lease(reduce_id, state, owner, lease_seconds)
+        claim.lease = None if new_state is UNCHANGED else new_state
+        return new_state
 
-        # If CAS fails, wait for other reviewer finish
-        time.sleep(0.1)
+    attempts = 0
+    wait_time = MIN_WAIT
+    while True:
+        metrics.cas_attempts += 1
+        claim.previous = await db.transact(reduce_id, take_lease)
+        if claim.lease is not None or \
+                get_status(claim.previous) == FINISHED:
+            break
+        wait_start = time.time()
+        await db.wait_for_change(reduce_id,
+                                 random.uniform(MIN_WAIT, wait_time))
+        wait_time = min(wait_time * 2, MAX_WAIT)
+        metrics.waits += 1
+        metrics.wait_seconds += time.time() - wait_start
         attempts += 1
-        if not should_wait():
+        if max_attempts != -1 and attempts >= max_attempts:
             log.warning('Not waiting to become reviewer')
             return False
 
-    # We are reviewer, check to make sure previous reviewers did not finish
-    # already.
-    if db.get(reduce_id) == FINISHED:
+    if claim.lease is None:
         return False
-    else:
-        # We are the reviewer, reduce if we are ready
-        if ready_fn():
-            ret = reduce_fn()
-            db.set(reduce_id, FINISHED)
-            return ret
+
+    lease = claim.lease
+    claim.lost = False
+
+    async def renew():
+        while True:
+            await asyncio.sleep(lease_seconds / 3)
+            renewed = new_lease(owner, lease.token, lease_seconds)
+            if not await db.update_if(reduce_id,
+                                      lambda s: holds_lease(s, lease),
+                                      renewed):
+                log.error(f'Lost reviewer lease on {reduce_id}')
+                claim.lost = True
+                return
+
+    renewer = asyncio.ensure_future(renew())
+    try:
+        if await maybe_await(ready_fn()):
+            ret = await maybe_await(call_reduce_fn(reduce_fn, lease.token))
+            next_state = FINISHED
         else:
-            # Not ready, don't reduce
-            db.set(reduce_id, WAITING)
-            return False
+            ret = False
+            next_state = Box(status=WAITING, token=lease.token)
+    except BaseException:
+        renewer.cancel()
+        # Let waiters retry now rather than once our lease expires
+        await db.update_if(reduce_id, lambda s: holds_lease(s, lease),
+                           Box(status=WAITING, token=lease.token))
+        raise
+    finally:
+        renewer.cancel()
+    if claim.lost or not await db.update_if(
+            reduce_id, lambda s: holds_lease(s, lease), next_state):
+        log.error(f'Reviewer lease on {reduce_id} expired and was taken '
+                  f'over before we set it to {get_status(next_state)}')
+        return False
+    return ret
+
+
+def call_reduce_fn(reduce_fn: callable, token: int):
+    """Pass our fencing token to reduce_fns that take one"""
+    try:
+        params = inspect.signature(reduce_fn).parameters
+    except (TypeError, ValueError):
+        # i.e. some builtins
+        params = {}
+    if 'token' in params:
+        return reduce_fn(token=token)
+    return reduce_fn()
+
+
+async def maybe_await(value):
+    if inspect.isawaitable(value):
+        value = await value
+    return value
 
 
 def get_reduce_db():
     return get_db('botleague_reduce')
 
+
+def get_async_reduce_db() -> AsyncDB:
+    return get_async_db('botleague_reduce')
+
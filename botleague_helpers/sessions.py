@@ -0,0 +1,170 @@
+"""
+Shared requests session with pooled keep-alive connections, default
+timeouts and retries configured per endpoint, plus conditional GETs
+"""
+import io
+import os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from http.client import responses
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+from botleague_helpers.cache import CachePolicy, LRUCache
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+# Connections kept alive per host, enough for our concurrent pollers
+POOL_SIZE = 32
+
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = [500, 502, 504]
+
+# url prefix => (Retry, (connect timeout, read timeout))
+_endpoints: Dict[str, Tuple[Retry, Tuple[float, float]]] = {}
+_session = None
+_session_lock = threading.Lock()
+_session_pid = None
+
+# (url, authorization) => (etag, status code, headers, content)
+etag_cache = LRUCache(CachePolicy(max_entries=512))
+
+
+def connect_retry(tries=3) -> Retry:
+    """
+    Only retry failures to connect, where the request was never sent, so
+    it's safe for POSTs that aren't idempotent
+    """
+    return Retry(total=tries, connect=tries, read=0, status=0, other=0,
+                 backoff_factor=RETRY_BACKOFF)
+
+
+def idempotent_retry(methods: List[str] = ('GET', 'HEAD'), tries=5,
+                     backoff=RETRY_BACKOFF) -> Retry:
+    """
+    Also retry read errors and 5xx's, for requests that are safe to repeat.
+    429's and 503's are left to the caller, which knows how to honor
+    Retry-After while polling.
+    """
+    return Retry(total=tries, connect=tries, read=tries, status=tries,
+                 backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+                 allowed_methods=frozenset(methods), raise_on_status=False)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """Applies a default timeout, which requests.Session lacks"""
+    def __init__(self, timeout: Tuple[float, float], **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def configure_endpoint(url_prefix: str, retry: Retry,
+                       connect_timeout=CONNECT_TIMEOUT,
+                       read_timeout=READ_TIMEOUT):
+    """
+    Use retry and these timeouts for requests to urls starting with
+    url_prefix. The longest matching prefix wins.
+    """
+    timeout = (connect_timeout, read_timeout)
+    with _session_lock:
+        _endpoints[url_prefix] = (retry, timeout)
+        if _session is not None:
+            _session.mount(url_prefix, _create_adapter(retry, timeout))
+
+
+def get_session() -> requests.Session:
+    """
+    :return: This process's shared session. Requests to endpoints that
+        haven't been configured only retry failures to connect.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        # Pooled connections can't be shared with a forked child
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            default = (connect_retry(), (CONNECT_TIMEOUT, READ_TIMEOUT))
+            for prefix in ['http://', 'https://']:
+                session.mount(prefix, _create_adapter(*default))
+            for prefix, (retry, timeout) in _endpoints.items():
+                session.mount(prefix, _create_adapter(retry, timeout))
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+
+def _create_adapter(retry, timeout) -> TimeoutHTTPAdapter:
+    return TimeoutHTTPAdapter(timeout, max_retries=retry,
+                              pool_connections=POOL_SIZE,
+                              pool_maxsize=POOL_SIZE)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    :return: Seconds to wait from a Retry-After header, which may be a
+        number of seconds or an HTTP date, or None if it's missing or invalid
+    """
+    if value is None:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0., retry_at.timestamp() - time.time())
+
+
+def conditional_get(url: str, headers: dict = None,
+                    **kwargs) -> requests.Response:
+    """
+    GET using If-None-Match with the ETag of our last response for url, i.e.
+    so GitHub doesn't count unchanged resources against our rate limit.
+    :return: The response, rebuilt from the cache on a 304, with
+        resp.from_cache set accordingly
+    """
+    headers = dict(headers or {})
+    cache_key = (url, headers.get('Authorization'))
+    found, cached = etag_cache.get(cache_key)
+    if found:
+        headers['If-None-Match'] = cached[0]
+    resp = get_session().get(url, headers=headers, **kwargs)
+    if found and resp.status_code == 304:
+        return _response_from_cache(resp, cached)
+    resp.from_cache = False
+    etag = resp.headers.get('ETag')
+    if resp.ok and etag:
+        etag_cache.put(cache_key, (etag, resp.status_code,
+                                   dict(resp.headers), resp.content))
+    return resp
+
+
+def _response_from_cache(not_modified: requests.Response,
+                         cached) -> requests.Response:
+    _, status_code, cached_headers, content = cached
+    ret = requests.Response()
+    ret.status_code = status_code
+    # Fresh headers, i.e. rate limits, update the cached ones
+    ret.headers = CaseInsensitiveDict(cached_headers)
+    ret.headers.update(not_modified.headers)
+    ret.raw = io.BytesIO(content)
+    ret.encoding = requests.utils.get_encoding_from_headers(ret.headers)
+    ret.url = not_modified.url
+    ret.reason = responses.get(status_code)
+    ret.request = not_modified.request
+    ret.elapsed = not_modified.elapsed
+    ret.connection = not_modified.connection
+    ret.from_cache = True
+    not_modified.close()
+    return ret
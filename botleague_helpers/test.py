@@ -1,12 +1,26 @@
+import asyncio
+import base64
+import datetime
+import json
 import random
 import string
 import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-from box import Box
+import requests
+from box import Box, BoxList
 from loguru import logger as log
 
-from botleague_helpers.db import get_db
-from botleague_helpers import reduce
+from botleague_helpers.async_db import get_async_db
+from botleague_helpers.cache import CachePolicy
+from botleague_helpers.config import get_test_name_from_callstack, \
+    override_test_name
+from botleague_helpers.db import DBSqlite, UNCHANGED, get_db
+from botleague_helpers import crypto, indexes, reduce
 
 TEST_DB_NAME = 'test_db_delete_me'
 
@@ -26,6 +40,870 @@ def test_compare_and_swap_live_db():
     db.delete_all_test_data()
 
 
+def test_get_set_delete_many():
+    db = get_db(TEST_DB_NAME)
+    db.set_many({'a': 1, 'b': Box(c=2), 'd': [3]})
+    got = db.get_many(['a', 'b', 'd'])
+    assert got == {'a': db.get('a'), 'b': db.get('b'), 'd': db.get('d')}
+    assert got['b'].c == 2
+    db.delete_many(['a', 'b'])
+    assert db.get_many(['a', 'd']) == {'a': None, 'd': [3]}
+
+    # Missing keys are skipped rather than stopping a delete part way
+    db.delete('missing')
+    db.delete_many(['missing', 'd'])
+    assert db.get('d') is None
+    db.delete_all_test_data()
+
+
+def test_db_cache():
+    db = get_db(TEST_DB_NAME, cache=CachePolicy(max_entries=2))
+    db.set('a', Box(b=1))
+    got = db.get('a')
+    got.b = 2  # Should not affect the cached value
+    assert db.get('a') == Box(b=1)
+    assert db.cache.hits == 2 and db.cache.misses == 0
+
+    db.collection['a'] = 'changed behind our back'
+    assert db.get('a') == Box(b=1)
+    assert db.compare_and_swap('a', Box(b=1), 'x') is False
+    assert db.get('a') == 'changed behind our back'
+
+    db.set('c', 1)
+    db.set('d', 1)
+    assert db.cache.evictions == 1
+    db.delete('d')
+    assert db.get('d') is None
+    db.delete_all_test_data()
+
+
+def test_local_compare_and_swap_threads():
+    db = get_db(TEST_DB_NAME)
+    assert db.compare_and_swap('missing', db.get('missing'), 0)
+
+    def increment():
+        for _ in range(200):
+            while True:
+                current = db.get('missing')
+                if db.compare_and_swap('missing', current, current + 1):
+                    break
+
+    threads = [threading.Thread(target=increment) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert db.get('missing') == 8 * 200
+    db.delete_all_test_data()
+
+
+def test_transact():
+    db = get_db(TEST_DB_NAME)
+    db.set('counter', Box(count=1))
+    previous = db.transact('counter', lambda c: Box(count=c.count + 1))
+    assert previous == Box(count=1)
+    assert db.get('counter').count == 2
+    assert db.transact('counter', lambda c: UNCHANGED).count == 2
+    assert not db.update_if('counter', lambda c: c.count > 2, 'nope')
+    assert db.update_if('counter', lambda c: c.count == 2, 'yep')
+    assert db.get('counter') == 'yep'
+    db.delete_all_test_data()
+
+
+def test_local_where():
+    db = get_db(TEST_DB_NAME)
+    db.set('a', Box(score=1, tags=['x'], nested=Box(name='a')))
+    db.set('b', Box(score=2.5, tags=['x', 'y'], nested=Box(name='b')))
+    db.set('c', Box(score='3', tags=[]))
+    db.set('plain', 1)
+
+    def keys(*args):
+        return [x.nested.name for x in db.where(*args)]
+
+    for with_indexes in [False, True]:
+        if with_indexes:
+            db.add_index('score', indexes.SORTED)
+            db.add_index('tags')
+            db.add_index('nested.name')
+        assert keys('score', '>=', 1) == ['a', 'b']
+        assert keys('score', '<', 2.5) == ['a']
+        assert keys('score', '<=', 2.5) == ['a', 'b']
+        assert keys('score', '>', 1) == ['b']
+        assert keys('score', '==', 1.0) == ['a']
+        assert keys('nested.name', 'in', ['b', 'z']) == ['b']
+        assert keys('tags', 'array_contains', 'y') == ['b']
+        assert keys('tags', 'array-contains', 'x') == ['a', 'b']
+
+    db.set('b', Box(score=0, tags=[], nested=Box(name='b')))
+    assert keys('score', '>', 1) == []
+    db.delete('a')
+    assert keys('tags', 'array_contains', 'x') == []
+    db.delete_all_test_data()
+
+
+def test_local_where_options():
+    db = get_db(TEST_DB_NAME)
+    db.set_many({f'bot_{i}': Box(score=i, name=f'bot_{i}', extra='x')
+                 for i in range(10)})
+    page = list(db.where('score', '>=', 2, order_by='score', descending=True,
+                         limit=3, select=['score', 'name']))
+    assert page == [Box(score=9, name='bot_9'), Box(score=8, name='bot_8'),
+                    Box(score=7, name='bot_7')]
+    next_page = list(db.where('score', '>=', 2, order_by='score',
+                              descending=True, limit=3,
+                              start_after=page[-1]))
+    assert [x.score for x in next_page] == [6, 5, 4]
+    assert [x.score for x in db.where('score', '<', 2)] == [0, 1]
+    db.delete_all_test_data()
+
+
+def test_sqlite_db():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = f'{tmp_dir}/test.db'
+        db = DBSqlite(TEST_DB_NAME, use_boxes=True, path=path)
+        assert db.get('yo') == {}
+        assert db.compare_and_swap('yo', db.get('yo'), 1)
+        assert not db.compare_and_swap('yo', 2, 3)
+        assert db.transact('yo', lambda x: x + 1) == 1
+        assert db.update_if('yo', lambda x: x == 2, 1)
+        db.set('a', Box(b=1, c=['x']))
+        db.set('d', Box(b=2, c=['y']))
+
+        # Another connection, i.e. another process, sees the same data
+        other = DBSqlite(TEST_DB_NAME, use_boxes=True, path=path)
+        assert other.get('yo') == 1
+        assert other.get('a').b == 1
+        assert [x.b for x in other.where('b', '>=', 1)] == [1, 2]
+        assert [x.b for x in other.where('c', 'array_contains', 'y')] == [2]
+
+        # Types Firestore stores natively, i.e. KMS ciphertext
+        when = datetime.datetime(2019, 5, 1, 12, tzinfo=datetime.timezone.utc)
+        db.set('native', dict(data=b'\x00\xff', when=when))
+        assert other.get('native') == dict(data=b'\x00\xff', when=when)
+        assert [x.data for x in other.where(
+            'when', '>', when - datetime.timedelta(days=1))] == [b'\x00\xff']
+        crypto.use_fake_kms()
+        try:
+            crypto.encrypt_db_key('shh', 'MY_SECRET', db=db)
+            assert crypto.decrypt_db_key('MY_SECRET', db=other,
+                                         use_cache=False) == 'shh'
+        finally:
+            crypto.reset_kms_clients()
+            crypto.kms_client_factory = crypto._create_kms_client
+        db.delete_all_test_data()
+        assert other.get('a') == {}
+
+
+def test_sqlite_where_mixed_types():
+    values = [1, 2.5, '3', True, False, None, [1, 'x'], dict(x=1)]
+    local_db = get_db(TEST_DB_NAME)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = DBSqlite(TEST_DB_NAME, use_boxes=True, path=f'{tmp_dir}/test.db')
+        for each_db in [db, local_db]:
+            for i, value in enumerate(values):
+                each_db.set(f'doc_{i}', dict(name=i, a=value))
+            each_db.set('no_a', dict(name=-1))
+
+        def names(each_db, *args):
+            return [d.name for d in each_db.where('a', *args)]
+
+        # Comparisons only match values of the same type, like Firestore
+        assert names(db, '>', 0) == [0, 1]
+        assert names(db, '==', True) == [3]
+        assert names(db, '==', 1) == [0]
+        assert names(db, '==', None) == [5]
+        assert names(db, '<', '4') == [2]
+        assert names(db, 'array_contains', 1) == [6]
+        for args in [('>', 0), ('>=', False), ('==', True), ('==', 1),
+                     ('==', None), ('<', '4'), ('in', [1, '3', None]),
+                     ('array_contains', 1), ('array_contains', 'x')]:
+            assert names(db, *args) == names(local_db, *args), args
+    local_db.delete_all_test_data()
+
+
+def test_encrypt_db_key_fake_kms():
+    crypto.use_fake_kms()
+    try:
+        db = get_db(TEST_DB_NAME)
+        secret = Box({f'field_{i}': f'value_{i}' for i in range(20)})
+        crypto.encrypt_db_key(secret, 'MY_SECRET', db=db)
+        assert db.get('MY_SECRET_encrypted') != secret
+        assert crypto.decrypt_db_key('MY_SECRET', db=db,
+                                     use_cache=False) == secret
+        assert len(crypto._kms_clients) == 1
+        client, _ = crypto.get_kms_client()
+
+        # Envelope encryption takes one KMS call for all fields
+        crypto.encrypt_db_key(secret, 'MY_ENVELOPE', db=db, envelope=True)
+        assert db.get('MY_ENVELOPE_encrypted').fields.field_0 != 'value_0'
+        client.num_requests = 0
+        assert crypto.decrypt_db_key('MY_ENVELOPE', db=db) == secret
+        assert client.num_requests == 1
+
+        # Then it's cached until invalidated
+        assert crypto.decrypt_db_key('MY_ENVELOPE', db=db) == secret
+        assert client.num_requests == 1
+        crypto.encrypt_db_key('new value', 'MY_ENVELOPE', db=db, envelope=True)
+        assert crypto.decrypt_db_key('MY_ENVELOPE', db=db) == 'new value'
+        assert client.num_requests == 3
+    finally:
+        crypto.invalidate_secret()
+        crypto.reset_kms_clients()
+        crypto.kms_client_factory = crypto._create_kms_client
+    db.delete_all_test_data()
+
+
+def test_bulk_secrets_fake_kms():
+    crypto.use_fake_kms()
+    try:
+        db = get_db(TEST_DB_NAME)
+        secrets = {'TOKEN_A': 'a', 'TOKEN_B': {'user': 'b', 'pass': 'c'}}
+        timings = Box()
+        crypto.encrypt_secrets(secrets, db=db, timings=timings)
+        assert set(timings) == {'connect', 'kms', 'write'}
+        assert db.get('TOKEN_A_encrypted') != 'a'
+        assert crypto.decrypt_secrets(db=db) == secrets
+        assert crypto.decrypt_secrets(['TOKEN_A'], db=db) == {'TOKEN_A': 'a'}
+
+        assert sorted(crypto.rotate_secrets(db=db, envelope=True)) == \
+            ['TOKEN_A', 'TOKEN_B']
+        assert crypto.ENVELOPE_KEY_FIELD in db.get('TOKEN_B_encrypted')
+        assert crypto.decrypt_secrets(db=db) == secrets
+    finally:
+        crypto.invalidate_secret()
+        crypto.reset_kms_clients()
+        crypto.kms_client_factory = crypto._create_kms_client
+    db.delete_all_test_data()
+
+
+def test_crypto_cli_args():
+    args = crypto.parse_args(['--encrypt', 'NAME', 'VALUE', '--envelope'])
+    assert args.encrypt == ['NAME', 'VALUE']
+    assert args.envelope
+    args = crypto.parse_args(['--envelope', '--encrypt', 'NAME', 'VALUE'])
+    assert args.encrypt == ['NAME', 'VALUE']
+    args = crypto.parse_args(['--decrypt'])
+    assert args.decrypt == '' and not args.envelope
+    assert crypto.parse_args(['--decrypt', 'NAME']).decrypt == 'NAME'
+    assert crypto.parse_args(['--rotate', '--envelope']).rotate
+
+
+def test_test_name_from_callstack():
+    def nested():
+        return get_test_name_from_callstack()
+    assert nested() == 'test_name_from_callstack'
+    override_test_name('')
+    try:
+        assert not get_test_name_from_callstack()
+    finally:
+        override_test_name(None)
+    assert get_test_name_from_callstack() == 'test_name_from_callstack'
+
+
+def test_delete_firestore_collection():
+    from botleague_helpers.db import delete_firestore_collection
+    docs = {f'doc_{i:02}': i for i in range(23)}
+    batch_sizes = []
+    progress = []
+
+    class FakeQuery:
+        def __init__(self, after=None, limit=None):
+            self.after = after
+            self.max_docs = limit
+
+        def select(self, fields):
+            assert fields == []
+            return self
+
+        def limit(self, max_docs):
+            return FakeQuery(self.after, max_docs)
+
+        def start_after(self, snapshot):
+            return FakeQuery(snapshot.reference, self.max_docs)
+
+        def stream(self):
+            keys = sorted(k for k in docs
+                          if self.after is None or k > self.after)
+            return [Box(reference=k) for k in keys[:self.max_docs]]
+
+    class FakeBatch:
+        def __init__(self):
+            self.refs = []
+
+        def delete(self, ref):
+            self.refs.append(ref)
+
+        def commit(self):
+            batch_sizes.append(len(self.refs))
+            for ref in self.refs:
+                del docs[ref]
+
+    client = Box(batch=FakeBatch)
+    deleted = delete_firestore_collection(FakeQuery(), batch_size=10,
+                                          progress_fn=progress.append,
+                                          client=client)
+    assert deleted == 23
+    assert not docs
+    assert batch_sizes == [10, 10, 3]
+    assert [(p.deleted, p.batches) for p in progress] == \
+        [(10, 1), (20, 2), (23, 3)]
+    assert all(p.elapsed >= 0 for p in progress)
+
+    # Concurrent batches, where pages are read before earlier ones commit
+    docs.update({f'doc_{i:02}': i for i in range(23)})
+    assert delete_firestore_collection(FakeQuery(), batch_size=5,
+                                       num_workers=3, client=client) == 23
+    assert not docs
+
+
+@contextmanager
+def offline_firestore(docs: list, use_async=False):
+    """
+    Serve docs, already in the order the query asks for, to queries'
+    stream() in pages, building each query like Firestore would so that
+    invalid cursors raise
+    :return: Collection on a client that never connects, and the pages
+        served as Box(fields, cursor, docs)
+    """
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud import firestore
+    from google.cloud.firestore_v1.async_query import AsyncQuery
+    from google.cloud.firestore_v1.document import DocumentSnapshot
+    from google.cloud.firestore_v1.query import Query
+    client_class = firestore.AsyncClient if use_async else firestore.Client
+    query_class = AsyncQuery if use_async else Query
+    client = client_class(project='test', credentials=AnonymousCredentials())
+    collection = client.collection(TEST_DB_NAME)
+    pages = []
+
+    def get_page(query):
+        proto = query._to_protobuf()
+        fields = [f.field_path for f in proto.select.fields]
+        # The order_by value, then the document name
+        cursor = [v.integer_value for v in proto.start_at.values[:1]]
+        start = sum(len(p.docs) for p in pages)
+        page = docs[start:start + proto.limit]
+        pages.append(Box(fields=fields, cursor=cursor, docs=page))
+        return [DocumentSnapshot(collection.document(d['name']),
+                                 {f: d[f] for f in fields}, True, None,
+                                 None, None) for d in page]
+
+    stream = query_class.stream
+    if use_async:
+        async def fake_stream(query, *args, **kwargs):
+            for snapshot in get_page(query):
+                yield snapshot
+    else:
+        def fake_stream(query, *args, **kwargs):
+            yield from get_page(query)
+    query_class.stream = fake_stream
+    try:
+        yield collection, pages
+    finally:
+        query_class.stream = stream
+
+
+def test_firestore_where_paging():
+    from botleague_helpers.db import DB, DBFirestore
+    docs = [dict(name=f'bot_{i}', score=i, secret='x') for i in range(7)]
+    with offline_firestore(docs) as (collection, pages):
+        db = DBFirestore.__new__(DBFirestore)
+        DB.__init__(db, TEST_DB_NAME, use_boxes=True)
+        db.collection = collection
+
+        # Ordering by a field we don't select
+        results = list(db.where('score', '>=', 0, order_by='score',
+                                select=['name'], page_size=3))
+        assert results == [dict(name=d['name']) for d in docs]
+        assert [len(p.docs) for p in pages] == [3, 3, 1]
+        assert [p.cursor for p in pages] == [[], [2], [5]]
+        assert all(p.fields == ['name', 'score'] for p in pages)
+
+    # The async backend pages the same way
+    from botleague_helpers.async_db import AsyncDB, AsyncDBFirestore
+    with offline_firestore(docs, use_async=True) as (collection, pages):
+        async_db = AsyncDBFirestore.__new__(AsyncDBFirestore)
+        AsyncDB.__init__(async_db, TEST_DB_NAME, use_boxes=True)
+        async_db.collection = collection
+
+        async def run():
+            return [d async for d in async_db.where(
+                'score', '>=', 0, order_by='score', select=['name'],
+                page_size=3)]
+
+        loop = asyncio.new_event_loop()
+        assert loop.run_until_complete(run()) == \
+            [dict(name=d['name']) for d in docs]
+        loop.close()
+        assert [p.cursor for p in pages] == [[], [2], [5]]
+
+
+def test_lazy_sdk_imports():
+    from botleague_helpers.bench import HEAVY_SDK_PREFIXES, get_import_times
+    _, modules = get_import_times('from botleague_helpers.db import get_db')
+    assert not [m for m in modules if m.startswith(HEAVY_SDK_PREFIXES)]
+
+
+def test_stackdriver_worker():
+    from botleague_helpers import logs
+    committed = []
+    unblock = threading.Event()
+
+    class FakeBatch:
+        def __init__(self):
+            self.entries = []
+
+        def log_struct(self, info, severity, timestamp):
+            self.entries.append((info, severity))
+
+        def commit(self):
+            unblock.wait()
+            committed.append(self.entries)
+
+    class FakeStackdriverLogger:
+        def batch(self):
+            return FakeBatch()
+
+    worker = logs.StackdriverWorker(FakeStackdriverLogger(),
+                                    max_queue_size=10, batch_size=5,
+                                    flush_seconds=0.05, when_full=logs.DROP)
+    records = []
+    log_id = log.add(lambda m: records.append(m.record))
+    log.bind(request_id=1).success('hello')
+    log.remove(log_id)
+    entry = logs.get_stackdriver_entry(records[0])
+    assert entry.severity == 'NOTICE'
+    assert entry.info.message == 'hello'
+    assert entry.info.extra.request_id == 1
+
+    # The first batch blocks in commit, so later entries back up and drop
+    for _ in range(30):
+        worker.put(entry)
+    assert worker.stats.dropped > 0
+    unblock.set()
+    assert worker.flush(timeout=5)
+    assert worker.stats.queue_depth == 0
+    assert all(len(batch) <= 5 for batch in committed)
+    assert sum(len(b) for b in committed) == worker.stats.sent == \
+        30 - worker.stats.dropped
+    assert committed[0][0] == (entry.info.to_dict(), 'NOTICE')
+    worker.close()
+
+    # Closing is bounded even with a full queue and a stuck commit
+    unblock.clear()
+    worker = logs.StackdriverWorker(FakeStackdriverLogger(),
+                                    max_queue_size=2, batch_size=1,
+                                    flush_seconds=0.05, when_full=logs.DROP)
+    for _ in range(5):
+        worker.put(entry)
+    start = time.time()
+    assert not worker.close(timeout=0.3)
+    assert time.time() - start < 2
+    unblock.set()
+
+
+def test_slack_worker():
+    from botleague_helpers import logs
+    assert logs.normalize_error_message(
+        'Eval 1234 of bot 5f3a9c0e21b7 failed after 0x1f ms') == \
+        logs.normalize_error_message(
+        'Eval 99 of bot a3b9f1e2d4c6 failed after 0x20 ms')
+
+    posted = []
+    worker = logs.SlackWorker(posted.append, messages_per_second=0.001,
+                              burst=2)
+    records = []
+    log_id = log.add(lambda m: records.append(m.record))
+    for i in range(10):
+        log.error(f'Eval {i} failed')
+        log.error(f'Problem {i} failed')
+    log.error('Something else failed')
+    log.remove(log_id)
+
+    for record in records:
+        worker.put(Box(text=record['message'], summary=record['message'],
+                       fingerprint=logs.get_error_fingerprint(record),
+                       time=record['time']))
+    assert worker.flush(timeout=5)
+    # Two distinct errors within the burst, then a digest of the rest
+    assert len(posted) == 3
+    assert posted[0] == '```Eval 0 failed```'
+    assert posted[1] == '```Problem 0 failed```'
+    assert posted[2].startswith('1 more error occurrences')
+    assert '1x Something else failed' in posted[2]
+    assert worker.stats.deduped == 18
+    assert worker.stats.fingerprints == 3
+    worker.close()
+
+    # Failed uploads of long messages fall back to posting them truncated
+    def fail_upload(**kwargs):
+        raise RuntimeError('No GCS for you')
+
+    upload_str = logs.upload.upload_str
+    logs.upload.upload_str = fail_upload
+    try:
+        posted.clear()
+        worker = logs.SlackWorker(posted.append)
+        long_text = 'x' * 600 + 'y' * 600
+        for text in [long_text, 'After the failed upload']:
+            worker.put(Box(text=text, summary=text[:10],
+                           fingerprint=text[:10], time=records[0]['time']))
+        assert worker.flush(timeout=5)
+        assert posted == [logs.truncate_message(long_text),
+                          '```After the failed upload```']
+        assert worker.stats.failed == 1
+        assert worker.close()
+    finally:
+        logs.upload.upload_str = upload_str
+
+    # Closing is bounded even with a full queue and a stuck post
+    unblock = threading.Event()
+    worker = logs.SlackWorker(lambda text: unblock.wait(), max_queue_size=2)
+    for record in records[:5]:
+        worker.put(Box(text=record['message'], summary=record['message'],
+                       fingerprint=f'{random.random()}',
+                       time=record['time']))
+    start = time.time()
+    assert not worker.close(timeout=0.3)
+    assert time.time() - start < 2
+    unblock.set()
+
+
+@contextmanager
+def serve_json(handle_fn):
+    """
+    Run a local HTTP server in a thread
+    :param handle_fn: (method, path, json body, headers) =>
+        (status code, json response, response headers)
+    :return: The server's base url
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def handle_request(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length)) if length else None
+            status, resp, headers = handle_fn(self.command, self.path, body,
+                                              self.headers)
+            content = json.dumps(resp).encode() if resp is not None else b''
+            self.send_response(status)
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        do_GET = do_POST = do_PATCH = handle_request
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_wait_for_problem_cis_concurrently():
+    from botleague_helpers import ci
+    polls = Box(default_box=True, default_box_attr=0)
+    lock = threading.Lock()
+
+    def handle(method, path, body, headers):
+        pr_number = body['pr_number']
+        with lock:
+            polls[str(pr_number)] += 1
+            num_polls = polls[str(pr_number)]
+        if pr_number == 1 and num_polls == 1:
+            return 429, None, {'Retry-After': '0.2'}
+        if pr_number == 3 and num_polls == 1:
+            return 500, None, None
+        status = 'passed' if num_polls >= pr_number else 'pending'
+        return 200, dict(status=status), None
+
+    with serve_json(handle) as url:
+        host = ci.BOTLEAGUE_LIAISON_HOST
+        ci.BOTLEAGUE_LIAISON_HOST = url
+        try:
+            problem_cis = ci.wait_for_problem_cis(
+                BoxList([Box(pr_number=i, commit='abc') for i in range(1, 5)]),
+                min_poll_seconds=0.01, max_poll_seconds=0.1)
+        finally:
+            ci.BOTLEAGUE_LIAISON_HOST = host
+    assert all(p.status == 'passed' for p in problem_cis)
+    assert all('poll_errors' not in p for p in problem_cis)
+    # Finished PR's aren't polled again
+    assert polls['1'] == 2
+    assert polls['2'] == 2
+    assert polls['4'] == 4
+
+
+def test_wait_for_job_to_finish():
+    from botleague_helpers import ci
+    from botleague_helpers.waiter import CallbackListener
+    job = Box(finished=False)
+
+    def handle(method, path, body, headers):
+        assert path == '/job/status'
+        status = 'finished' if job.finished else 'running'
+        return 200, dict(id=body['job_id'], status=status), None
+
+    with serve_json(handle) as url, CallbackListener() as callback:
+        host = ci.DEEPDRIVE_SIM_HOST
+        ci.DEEPDRIVE_SIM_HOST = url
+        try:
+            # Times out when nothing happens
+            metrics = Box()
+            try:
+                ci.wait_for_job_to_finish('my_job', timeout=0.3,
+                                          min_poll_seconds=0.05,
+                                          metrics=metrics)
+                assert False, 'Should have timed out'
+            except TimeoutError:
+                pass
+            assert metrics.polls >= 2
+            assert metrics.first_status_seconds < metrics.wait_seconds
+
+            # A callback means we don't wait out the 10s poll delay
+            def finish():
+                time.sleep(0.2)
+                job.finished = True
+                requests.post(callback.url, json=dict(job_id='my_job'))
+            threading.Thread(target=finish).start()
+            start = time.time()
+            result = ci.wait_for_job_to_finish('my_job', timeout=30,
+                                               callback=callback,
+                                               min_poll_seconds=10)
+            assert result.status == 'finished'
+            assert time.time() - start < 5
+            assert list(callback.payloads) == [dict(job_id='my_job')]
+        finally:
+            ci.DEEPDRIVE_SIM_HOST = host
+
+
+def test_create_problem_cis_concurrently():
+    from botleague_helpers import ci
+    problems = [f'problem_{i}' for i in range(6)]
+
+    def create(problem):
+        time.sleep(0.2)
+        return Box(pr_number=int(problem.split('_')[-1]), commit='abc')
+
+    start = time.time()
+    problem_cis = ci.create_problem_cis(problems, create)
+    assert time.time() - start < 0.2 * len(problems) / 2
+    assert [p.pr_number for p in problem_cis] == list(range(6))
+
+    def create_or_fail(problem):
+        if problem in ['problem_1', 'problem_4']:
+            raise ValueError(f'{problem} is broken')
+        return create(problem)
+
+    try:
+        ci.create_problem_cis(problems, create_or_fail)
+        assert False, 'Should have raised'
+    except RuntimeError as e:
+        message = str(e)
+    assert '2 of 6' in message
+    assert 'problem_1 is broken' in message
+    assert 'problem_4 is broken' in message
+    assert 'Created PRs: 0, 2, 3, 5' in message
+
+
+def test_session_retries_and_etags():
+    from botleague_helpers import sessions
+    hits = Box(default_box=True, default_box_attr=0)
+
+    def handle(method, path, body, headers):
+        hits[path] += 1
+        if path == '/flaky' and hits[path] < 3:
+            return 500, None, None
+        if path == '/etag':
+            if headers.get('If-None-Match') == '"v1"':
+                return 304, None, {'ETag': '"v1"'}
+            return 200, dict(sha='abc'), {'ETag': '"v1"'}
+        return 200, dict(ok=True), None
+
+    endpoints = dict(sessions._endpoints)
+    try:
+        with serve_json(handle) as url:
+            sessions.configure_endpoint(
+                f'{url}/flaky', sessions.idempotent_retry(['POST'], backoff=0))
+            session = sessions.get_session()
+            assert session.post(f'{url}/flaky', json={}).ok
+            assert hits['/flaky'] == 3
+
+            # POSTs to other endpoints aren't retried
+            hits['/flaky'] = 0
+            sessions.configure_endpoint(f'{url}/flaky',
+                                        sessions.connect_retry())
+            assert session.post(f'{url}/flaky', json={}).status_code == 500
+            assert hits['/flaky'] == 1
+
+            headers = dict(Authorization='token abc')
+            first = sessions.conditional_get(f'{url}/etag',
+                                             headers=headers)
+            second = sessions.conditional_get(f'{url}/etag',
+                                              headers=headers)
+            assert not first.from_cache
+            assert second.from_cache
+            assert second.status_code == 200
+            assert second.reason == 'OK'
+            assert second.json() == first.json() == dict(sha='abc')
+            assert hits['/etag'] == 2
+    finally:
+        # Drop our test endpoints and the session they're mounted on
+        with sessions._session_lock:
+            sessions._endpoints.clear()
+            sessions._endpoints.update(endpoints)
+            if sessions._session is not None:
+                sessions._session.close()
+            sessions._session = None
+        sessions.etag_cache.clear()
+
+
+def test_github_scheduler():
+    from github import Github
+    from botleague_helpers import github_limits
+    budget = Box(remaining=100, reset_at=time.time() + 1)
+    write_times = []
+
+    def handle(method, path, body, headers):
+        budget.remaining -= 1
+        if method != 'GET':
+            write_times.append(time.time())
+        rate_headers = {'X-RateLimit-Limit': '5000',
+                        'X-RateLimit-Remaining': str(budget.remaining),
+                        'X-RateLimit-Reset': str(budget.reset_at)}
+        return 200, dict(full_name='botleague/botleague', name='botleague',
+                         number=1), rate_headers
+
+    scheduler = github_limits.scheduler
+    github_limits.scheduler = github_limits.GitHubScheduler(
+        write_interval=0.2, reserved_requests=95)
+    try:
+        with serve_json(handle) as url:
+            github_limits.install_pygithub_hooks()
+            repo = Github(base_url=url, seconds_between_requests=None,
+                          seconds_between_writes=None).get_repo(
+                'botleague/botleague')
+            assert repo.full_name == 'botleague/botleague'
+            assert github_limits.scheduler.stats.remaining == 99
+
+            # Writes are spaced out
+            threads = [threading.Thread(target=github_limits.github_request,
+                                        args=('POST', f'{url}/pulls'),
+                                        kwargs=dict(json={}))
+                       for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert write_times[2] - write_times[0] >= 0.35
+
+            # Down to our reserve, so we wait for the limit to reset
+            github_limits.github_request('GET', f'{url}/repo')
+            assert budget.remaining <= 95
+            github_limits.github_request('GET', f'{url}/repo')
+            assert time.time() >= budget.reset_at
+            stats = github_limits.scheduler.stats
+            assert stats.requests == 6
+            assert stats.writes == 3
+            assert stats.throttled_seconds > 0.5
+    finally:
+        github_limits.uninstall_pygithub_hooks()
+        github_limits.scheduler = scheduler
+
+
+def test_github_scheduler_retry_after():
+    from email.utils import formatdate
+    from botleague_helpers.github_limits import GitHubScheduler
+    scheduler = GitHubScheduler()
+    # Retry-After can also be an HTTP date
+    scheduler.observe(429, {'Retry-After': formatdate(time.time() + 30,
+                                                      usegmt=True)})
+    assert 25 < scheduler.blocked_until - time.time() <= 30
+    scheduler.observe(403, {'Retry-After': '60'})
+    assert 55 < scheduler.blocked_until - time.time() <= 60
+    scheduler.observe(429, {'Retry-After': 'soon'})
+    assert scheduler.stats.rate_limited == 2
+
+
+def test_pygithub_conditional_gets():
+    from github import Github
+    from botleague_helpers import github_limits, sessions
+    requests_headers = []
+
+    def handle(method, path, body, headers):
+        requests_headers.append(headers)
+        if headers.get('If-None-Match') == '"v1"':
+            return 304, None, {'ETag': '"v1"'}
+        return 200, dict(full_name='botleague/botleague',
+                         name='botleague'), {'ETag': '"v1"'}
+
+    try:
+        with serve_json(handle) as url:
+            github_limits.install_pygithub_hooks()
+            github = Github(base_url=url, seconds_between_requests=None)
+            first = github.get_repo('botleague/botleague')
+            second = github.get_repo('botleague/botleague')
+            assert first.full_name == second.full_name == \
+                'botleague/botleague'
+            assert len(requests_headers) == 2
+            assert requests_headers[1]['If-None-Match'] == '"v1"'
+    finally:
+        github_limits.uninstall_pygithub_hooks()
+        sessions.etag_cache.clear()
+
+
+def test_github_file_cache():
+    from botleague_helpers import utils
+    files = {'problems/a/problem.json': b'{"version": 1}'}
+    downloads = []
+
+    class FakeRepo:
+        html_url = 'https://github.com/fake/repo'
+
+        def get_contents(self, path, ref=None):
+            return [Box(path=k, type='file', sha=utils.get_git_blob_sha(v))
+                    for k, v in files.items()
+                    if k.rsplit('/', 1)[0] == path]
+
+        def get_git_blob(self, sha):
+            downloads.append(sha)
+            for content in files.values():
+                if utils.get_git_blob_sha(content) == sha:
+                    return Box(encoding='base64',
+                               content=base64.b64encode(content).decode())
+
+    repo = FakeRepo()
+    path = 'problems/a/problem.json'
+    utils.github_file_cache.clear()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        problem, sha = utils.get_file_and_sha_from_github(
+            repo, path, ref='master', cache_dir=cache_dir)
+        assert problem == dict(version=1)
+        problem.version = 2  # Mustn't change the cached copy
+        assert utils.get_file_and_sha_from_github(
+            repo, path, cache_dir=cache_dir) == (dict(version=1), sha)
+        assert len(downloads) == 1
+
+        # New processes read from disk
+        utils.github_file_cache.clear()
+        assert utils.get_file_and_sha_from_github(
+            repo, path, cache_dir=cache_dir)[0] == dict(version=1)
+        assert len(downloads) == 1
+
+        files[path] = b'{"version": 3}'
+        assert utils.get_file_from_github(repo, path) == dict(version=3)
+        assert len(downloads) == 2
+        assert utils.get_file_and_sha_from_github(
+            repo, 'problems/a/missing.json') == ('', '')
+    utils.github_file_cache.clear()
+
+
 def test_namespace_live_db():
     rand_str_get_set(collection_name='')
     rand_str_get_set(collection_name=TEST_DB_NAME)
@@ -70,6 +948,220 @@ def test_reduce():
     db.delete_all_test_data()
 
 
+def test_local_change_listeners():
+    db = get_db(TEST_DB_NAME)
+    notifier = db.notifier
+    seen = []
+
+    def listener():
+        # Reading the key we're notified about mustn't deadlock the writer
+        seen.append(db.get('watched'))
+
+    notifier.subscribe('watched', listener)
+    writer = threading.Thread(target=db.set, args=('watched', 1),
+                              daemon=True)
+    writer.start()
+    writer.join(timeout=5)
+    assert not writer.is_alive()
+    assert seen == [1]
+    db.transact('watched', lambda x: x + 1)
+    db.delete_many(['watched', 'missing'])
+    assert seen == [1, 2, None]
+
+    # Keys are forgotten once no one watches them
+    watcher = db.watch('watched')
+    notifier.unsubscribe('watched', listener)
+    assert 'watched' not in notifier.listeners
+    assert notifier.num_watchers['watched'] == 1
+    watcher.close()
+    assert 'watched' not in notifier.num_watchers
+    assert 'watched' not in notifier.versions
+    db.delete_all_test_data()
+
+
+def test_reduce_wakes_on_change():
+    db = get_db('test_reduce_wakes_on_change')
+    reduce_id = 'wake_me'
+    db.set(reduce_id, reduce.REVIEWING)
+
+    def finish_other_review():
+        time.sleep(0.5)
+        db.set(reduce_id, reduce.WAITING)
+
+    threading.Thread(target=finish_other_review).start()
+    metrics = Box()
+    start = time.time()
+    result = reduce.try_reduce_async(reduce_id, lambda: True, lambda: 'done',
+                                     db, metrics=metrics)
+    assert result == 'done'
+    # Woken by the change rather than waiting out the backoff
+    assert time.time() - start < 1.5
+    assert metrics.cas_attempts < 12
+    db.delete_all_test_data()
+
+
+def test_reduce_lease():
+    db = get_db('test_reduce_lease')
+    reduce_id = 'crashed_reviewer'
+    db.set(reduce_id, reduce.new_lease('dead', token=3, lease_seconds=-1))
+
+    def reduce_fn():
+        # Renewed while we're reducing
+        time.sleep(1)
+        assert db.get(reduce_id).lease_expires > time.time()
+        return 'taken over'
+
+    result = reduce.try_reduce_async(reduce_id, lambda: True, reduce_fn, db,
+                                     max_attempts=1, lease_seconds=0.5)
+    assert result == 'taken over'
+    assert db.get(reduce_id) == reduce.FINISHED
+
+    # Live leases are respected
+    db.set(reduce_id, reduce.new_lease('alive', token=5, lease_seconds=60))
+    result = reduce.try_reduce_async(reduce_id, lambda: True, reduce_fn, db,
+                                     max_attempts=1)
+    assert not result
+    assert db.get(reduce_id).owner == 'alive'
+
+    # Our result is discarded if we're taken over while reducing
+    db.set(reduce_id, reduce.WAITING)
+
+    def slow_reduce_fn(token):
+        assert db.get(reduce_id).token == token
+        db.set(reduce_id, reduce.new_lease('successor', token=token + 1,
+                                           lease_seconds=60))
+        return 'stale'
+
+    result = reduce.try_reduce_async(reduce_id, lambda: True,
+                                     slow_reduce_fn, db, max_attempts=1)
+    assert result is False
+    assert db.get(reduce_id).owner == 'successor'
+
+    # A failed reduce hands the lease back right away
+    db.set(reduce_id, reduce.WAITING)
+
+    def failing_reduce_fn():
+        raise RuntimeError('Reduce failed')
+
+    for _ in range(2):
+        try:
+            reduce.try_reduce_async(reduce_id, lambda: True, failing_reduce_fn,
+                                    db, max_attempts=1)
+            assert False, 'Expected the reduce to raise'
+        except RuntimeError:
+            pass
+        assert reduce.get_status(db.get(reduce_id)) == reduce.WAITING
+
+    async def async_failing_reduce_fn():
+        raise RuntimeError('Reduce failed')
+
+    async_db = get_async_db('test_reduce_lease')
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(reduce.try_reduce(
+            reduce_id, lambda: True, async_failing_reduce_fn, async_db,
+            max_attempts=1))
+        assert False, 'Expected the reduce to raise'
+    except RuntimeError:
+        pass
+    loop.close()
+    assert reduce.get_status(db.get(reduce_id)) == reduce.WAITING
+    assert reduce.try_reduce_async(reduce_id, lambda: True, lambda: 'retried',
+                                   db, max_attempts=1) == 'retried'
+    db.delete_all_test_data()
+
+
+def test_reduce_fan_in():
+    db = get_db('test_reduce_fan_in')
+    reduce_id = 'fan_in'
+    reduce.create_reduce(reduce_id, db, expected_count=20)
+    results = []
+
+    def mapper(items):
+        for item in items:
+            result = reduce.mark_item_done(reduce_id, item, lambda: 'reduced',
+                                           db)
+            if result:
+                results.append(result)
+
+    item_ids = [f'item_{i}' for i in range(20)]
+    threads = [threading.Thread(target=mapper, args=(item_ids[i::4],))
+               for i in range(4)]
+    # Duplicate marks shouldn't count twice
+    assert not reduce.mark_item_done(reduce_id, 'item_0', lambda: 'early', db)
+    assert not reduce.mark_item_done(reduce_id, 'item_0', lambda: 'early', db)
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['reduced']
+    assert reduce.count_items_done(reduce_id, db) == 20
+    assert db.get(reduce_id) == reduce.FINISHED
+
+    # Big reduces get more shards so their docs stay small
+    reduce.create_reduce('big', db, expected_count=25 *
+                         reduce.MAX_ITEMS_PER_SHARD - 1)
+    assert db.get(reduce.get_fan_in_key('big')).num_shards == 25
+    assert reduce.count_items_done('big', db) == 0
+    db.delete_all_test_data()
+
+
+def test_async_compare_and_swap():
+    sync_db = get_db('test_async_compare_and_swap')
+    db = get_async_db('test_async_compare_and_swap')
+
+    async def run():
+        # Missing keys match None or {} like the sync backends
+        for expected in [None, {}]:
+            assert sync_db.cas(f'sync_{expected}', expected, 1)
+            assert await db.cas(f'async_{expected}', expected, 1)
+        assert not await db.cas('async_None', {}, 2)
+        assert await db.cas('async_None', 1, 2)
+        assert await db.get('async_None') == 2
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(run())
+    loop.close()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sqlite_db = DBSqlite(TEST_DB_NAME, use_boxes=True,
+                             path=f'{tmp_dir}/test.db')
+        assert sqlite_db.cas('a', None, 1)
+        assert sqlite_db.cas('b', {}, 1)
+        assert not sqlite_db.cas('a', {}, 2)
+    sync_db.delete_all_test_data()
+
+
+def test_async_reduce():
+    db = get_async_db('test_async_reduce')
+    reduce_id = 'async'
+
+    async def run():
+        await db.set(reduce_id, reduce.REVIEWING)
+        assert await db.cas(reduce_id, reduce.REVIEWING, reduce.REVIEWING)
+
+        async def finish_other_review():
+            await asyncio.sleep(0.3)
+            await db.set(reduce_id, reduce.WAITING)
+
+        async def reduce_fn():
+            return 'done'
+
+        other = asyncio.ensure_future(finish_other_review())
+        results = await asyncio.gather(*[
+            reduce.try_reduce(reduce_id, lambda: True, reduce_fn, db)
+            for _ in range(50)])
+        await other
+        assert results.count('done') == 1
+        assert await db.get(reduce_id) == reduce.FINISHED
+
+    loop = asyncio.new_event_loop()
+    start = time.time()
+    loop.run_until_complete(run())
+    loop.close()
+    assert time.time() - start < 1.5
+    db.delete_all_test_data()
+
+
 def watch_collection_play():
     db = get_db(TEST_DB_NAME, force_firestore_db=True)
 
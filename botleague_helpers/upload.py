@@ -1,7 +1,6 @@
 import os
 import zipfile
 
-from google.cloud import storage
 from loguru import logger as log
 
 AWS_DEEPDRIVE_BUCKET_NAME = 'deepdrive'
@@ -10,6 +9,7 @@ GCS_DEEPDRIVE_BUCKET_NAME = 'deepdriveio'
 def upload_gcs(source_path: str, dest_path: str) -> str:
     log.info('Uploading %s to GCS bucket %s' % (source_path,
                                              GCS_DEEPDRIVE_BUCKET_NAME))
+    from google.cloud import storage
     key = dest_path
     storage_client = storage.Client()
     bucket = storage_client.get_bucket(GCS_DEEPDRIVE_BUCKET_NAME)
@@ -27,6 +27,7 @@ def upload_str(name: str, content: str, bucket_name: str):
     :param bucket_name: Name of GCS bucket, i.e. deepdriveio
     :return: Url of the public file
     """
+    from google.cloud import storage
     key = name
     bucket = storage.Client().get_bucket(bucket_name)
     blob = bucket.get_blob(key)
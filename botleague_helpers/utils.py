@@ -1,10 +1,15 @@
+import base64
+import hashlib
 import json
 import os
 import os.path as p
+import posixpath
 import sys
+import threading
+import time
 
 from subprocess import PIPE, Popen
-from typing import Union
+from typing import Optional, Tuple, Union
 
 import requests
 from botleague_helpers.config import blconfig
@@ -13,22 +18,101 @@ from box import Box, BoxList
 
 from loguru import logger as log
 
-from github import UnknownObjectException
+from botleague_helpers.cache import CachePolicy, LRUCache
+
+# Blobs fetched by get_file_and_sha_from_github are kept here if set
+GITHUB_FILE_CACHE_DIR = os.environ.get('GITHUB_FILE_CACHE_DIR')
+
+# (blob sha, is json) => content, parsed for json
+github_file_cache = LRUCache(CachePolicy(max_entries=256))
 
 
 def get_file_from_github(repo, filename, ref=None):
     """@:param filename: relative path to file in repo"""
+    ret, _ = get_file_and_sha_from_github(repo, filename, ref)
+    return ret
+
+
+def get_file_and_sha_from_github(repo, filename, ref=None,
+                                 cache_dir: str = None) -> \
+        Tuple[Union[str, Box], str]:
+    """
+    Get a file's content, parsed into a Box for .json files, and its blob
+    SHA. Content is cached by blob SHA, so unless the file changed we only
+    list its directory to find the SHA. Entry points can make that listing
+    free while it's unchanged with github_limits.install_pygithub_hooks(),
+    as run_botleague_ci does.
+
+    :param filename: relative path to file in repo
+    :param cache_dir: Directory to keep blobs in across processes, defaults
+        to GITHUB_FILE_CACHE_DIR
+    :return: (content, blob sha), or ('', '') if the file doesn't exist
+    """
+    from github import UnknownObjectException
+    cache_dir = cache_dir or GITHUB_FILE_CACHE_DIR
     try:
-        args = [filename]
-        if ref is not None:
-            args.append(ref)
-        contents = repo.get_contents(*args)
-        content_str = contents.decoded_content.decode('utf-8')
+        sha = get_github_blob_sha(repo, filename, ref)
     except UnknownObjectException:
-        log.error('Unable to find %s in %s', filename, repo.html_url)
-        content_str = ''
-    ret = get_str_or_box(content_str, filename)
-    return ret
+        sha = None
+    if sha is None:
+        log.error(f'Unable to find {filename} in {repo.html_url}')
+        return get_str_or_box('', filename), ''
+    cache_key = (sha, filename.endswith('.json'))
+    found, ret = github_file_cache.get(cache_key)
+    if not found:
+        content_str = read_github_blob(repo, sha, cache_dir).decode('utf-8')
+        ret = get_str_or_box(content_str, filename)
+        github_file_cache.put(cache_key, ret)
+    return ret, sha
+
+
+def get_github_blob_sha(repo, filename, ref=None) -> Optional[str]:
+    """
+    :return: The file's blob SHA at ref, from a listing of its directory,
+        which doesn't include file contents. With install_pygithub_hooks()
+        the listing is a conditional GET, so while the directory is
+        unchanged it doesn't count against our rate limit. Otherwise it
+        costs one request per call, plus one for the blob on a cache miss.
+    """
+    path = filename.strip('/')
+    args = [posixpath.dirname(path)]
+    if ref is not None:
+        args.append(ref)
+    entries = repo.get_contents(*args)
+    if not isinstance(entries, list):
+        entries = [entries]
+    for entry in entries:
+        if entry.path == path and entry.type == 'file':
+            return entry.sha
+    return None
+
+
+def read_github_blob(repo, sha: str, cache_dir: str = None) -> bytes:
+    blob_path = p.join(cache_dir, sha) if cache_dir else None
+    if blob_path and p.exists(blob_path):
+        with open(blob_path, 'rb') as blob_file:
+            content = blob_file.read()
+        if get_git_blob_sha(content) == sha:
+            return content
+        log.warning(f'Ignoring corrupt cached blob {blob_path}')
+    blob = repo.get_git_blob(sha)
+    if blob.encoding == 'base64':
+        content = base64.b64decode(blob.content)
+    else:
+        content = blob.content.encode('utf-8')
+    if blob_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write then rename so concurrent readers never see part of a blob
+        tmp_path = f'{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as blob_file:
+            blob_file.write(content)
+        os.replace(tmp_path, blob_path)
+    return content
+
+
+def get_git_blob_sha(content: bytes) -> str:
+    header = f'blob {len(content)}\0'.encode()
+    return hashlib.sha1(header + content).hexdigest()
 
 
 def get_str_or_box(content_str, filename):
@@ -259,5 +343,37 @@ def get_eval_db_key(eval_key):
     return '%s_%s' % ('botleague_eval', eval_key)
 
 
+class TokenBucket:
+    """
+    Allows bursts of up to capacity calls, refilling at rate tokens per
+    second
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def seconds_until_available(self, tokens: float = 1) -> float:
+        with self.lock:
+            self._refill()
+            return max(0., (tokens - self.tokens) / self.rate)
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+
 if __name__ == '__main__':
     ensure_nvidia_docker_runtime()
\ No newline at end of file
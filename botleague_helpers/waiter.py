@@ -0,0 +1,160 @@
+"""
+Polling with an overall deadline, exponential backoff with jitter and
+optional early wake ups from a callback, for waiting on builds and CI's
+"""
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable
+
+from box import Box
+from loguru import logger as log
+
+MIN_POLL_SECONDS = 1
+MAX_POLL_SECONDS = 30
+POLL_BACKOFF = 1.5
+
+# Fraction of each delay to randomize so many waiters don't poll in lockstep
+POLL_JITTER = 0.1
+
+LOG_INTERVAL = 60
+
+MAX_CALLBACK_PAYLOADS = 100
+MAX_CALLBACK_BYTES = 64 * 1024
+
+
+class Pending:
+    def __init__(self, progressed=False, retry_after: float = None):
+        """
+        Return from a poll fn to keep waiting
+        :param progressed: Something changed, so poll again soon
+        :param retry_after: The server asked us to wait this many seconds
+        """
+        self.progressed = progressed
+        self.retry_after = retry_after
+
+
+def wait_for(poll_fn: Callable[[], Any], name: str = '',
+             timeout: float = None,
+             min_poll_seconds=MIN_POLL_SECONDS,
+             max_poll_seconds=MAX_POLL_SECONDS,
+             backoff=POLL_BACKOFF,
+             jitter=POLL_JITTER,
+             wait_fn: Callable[[float], Any] = None,
+             metrics: Box = None) -> Any:
+    """
+    Call poll_fn until it returns something other than None or a Pending,
+    and return that.
+
+    :param timeout: Seconds to wait overall before raising TimeoutError
+    :param wait_fn: Called with the seconds to wait between polls instead of
+        time.sleep. It may return early, i.e. CallbackListener.wait when a
+        callback arrives, and we'll poll right away.
+    :param metrics: [Optional] Box to fill with polls, first_status_seconds
+        (latency of the first poll) and wait_seconds
+    """
+    wait_fn = wait_fn or time.sleep
+    metrics = Box() if metrics is None else metrics
+    metrics.polls = 0
+    metrics.first_status_seconds = None
+    metrics.wait_seconds = 0.
+    start = time.time()
+    deadline = None if timeout is None else start + timeout
+    delay = min_poll_seconds
+    last_log_time = start
+    while True:
+        ret = poll_fn()
+        now = time.time()
+        metrics.polls += 1
+        metrics.wait_seconds = now - start
+        if metrics.first_status_seconds is None:
+            metrics.first_status_seconds = now - start
+        if ret is not None and not isinstance(ret, Pending):
+            return ret
+        pending = ret or Pending()
+        if pending.progressed:
+            delay = min_poll_seconds
+        seconds = delay * random.uniform(1 - jitter, 1 + jitter)
+        if pending.retry_after:
+            seconds = max(seconds, pending.retry_after)
+        if deadline is not None:
+            if now >= deadline:
+                raise TimeoutError(f'Timed out waiting for {name} after '
+                                   f'{timeout}s and {metrics.polls} polls')
+            seconds = min(seconds, deadline - now)
+        if now - last_log_time > LOG_INTERVAL:
+            log.info(f'Still waiting for {name} after {now - start:.0f}s, '
+                     f'{metrics.polls} polls')
+            last_log_time = now
+        wait_fn(seconds)
+        delay = min(delay * backoff, max_poll_seconds)
+
+
+class CallbackListener:
+    """
+    Local HTTP endpoint that wakes up wait_for when anything is POSTed to
+    it, i.e. by a job server that supports completion webhooks. Use
+    listener.wait as wait_for's wait_fn.
+
+    Anyone who can reach it can wake us up, which only makes us poll
+    early, and it only listens on localhost unless you pass another host.
+    """
+    def __init__(self, host='127.0.0.1', port=0, public_host: str = None):
+        """
+        :param host: Interface to listen on, i.e. '0.0.0.0' for all of them
+        :param public_host: Host the sender should use to reach us
+        """
+        listener = self
+        self.event = threading.Event()
+        # The most recent callback bodies
+        self.payloads = deque(maxlen=MAX_CALLBACK_PAYLOADS)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length > MAX_CALLBACK_BYTES:
+                    self.send_response(413)
+                    self.end_headers()
+                    return
+                body = self.rfile.read(length) if length else b''
+                try:
+                    listener.payloads.append(json.loads(body or 'null'))
+                except ValueError:
+                    listener.payloads.append(body)
+                self.send_response(204)
+                self.end_headers()
+                listener.event.set()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.public_host = public_host or ('127.0.0.1' if host == '0.0.0.0'
+                                           else host)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.public_host}:{self.server.server_port}/'
+
+    def wait(self, seconds: float) -> bool:
+        """:return: True if we got a callback"""
+        # A callback arriving after this returns is fine, as we poll next
+        ret = self.event.wait(seconds)
+        self.event.clear()
+        return ret
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()